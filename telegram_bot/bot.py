@@ -5,17 +5,27 @@ VK Teams Export Bot для Telegram
 """
 
 import asyncio
-import gc
-import json
+import io
+import logging
 import os
+import queue
+import random
+import re
 import shutil
 import tempfile
+import time
 import uuid as uuid_mod
+import weakref
 import zipfile
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache, partial
+from logging.handlers import QueueHandler, QueueListener
 from typing import Optional
 
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import Bot, Dispatcher, Router
+from aiolimiter import AsyncLimiter
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -33,21 +43,33 @@ from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, Telegra
 
 import config
 from vkteams_client import VKTeamsClient, VKTeamsAuth, VKTeamsSession
-from export_formatter import format_as_html, format_as_json
+from user_state import RedisSessionStore, UserStateLRU
+from export_formatter import write_html, write_json
 
 # Stats tracking (lightweight)
 try:
-    from stats import (log_event, update_active_user, get_active_user_ids,
-                       update_user_export, get_setting, set_setting)
+    from stats import (log_event, flush_events, update_active_user, get_active_user_ids,
+                       update_user_export, get_settings, set_settings)
     STATS_ENABLED = True
 except ImportError:
     STATS_ENABLED = False
     def log_event(*args, **kwargs): pass
+    def flush_events(*args, **kwargs): pass
     def update_active_user(*args, **kwargs): pass
     def get_active_user_ids(): return []
     def update_user_export(*args, **kwargs): pass
-    def get_setting(key, default=""): return default
-    def set_setting(*args, **kwargs): pass
+    def get_settings(keys): return {}
+    def set_settings(*args, **kwargs): pass
+
+# zlib-ng (SIMD deflate/crc32) для zipfile, если установлен; формат архива тот же
+try:
+    from zlib_ng import zlib_ng
+    zipfile.zlib = zlib_ng
+    zipfile.crc32 = zlib_ng.crc32
+except ImportError:
+    pass
+
+logger = logging.getLogger(__name__)
 
 # Роутер для хэндлеров
 router = Router()
@@ -69,15 +91,209 @@ class ExportStates(StatesGroup):
 
 
 # Хранилище сессий пользователей (в продакшене использовать Redis/DB)
-user_sessions: dict[int, VKTeamsSession] = {}
-user_selected_chats: dict[int, list[str]] = {}
+# LRU + TTL: неактивные пользователи вытесняются, идущий экспорт — не трогаем
 user_exporting: dict[int, bool] = {}  # Блокировка повторных экспортов
-user_search_query: dict[int, str] = {}  # Поисковый запрос
-user_message_ids: dict[int, dict] = {}  # ID сообщений для удаления (code_msg, chats_msg)
-user_active_exports: dict[int, dict] = {}  # {user_id: {"uuid", "path", "created_at"}} — блокировка повторных выгрузок с файлами
+
+
+def _user_state() -> UserStateLRU:
+    return UserStateLRU(
+        config.USER_STATE_MAX_USERS,
+        config.USER_STATE_TTL_HOURS * 3600,
+        is_locked=lambda uid: uid in user_exporting,
+    )
+
+
+user_sessions: UserStateLRU = _user_state()  # {user_id: VKTeamsSession}
+user_selected_chats: UserStateLRU = _user_state()  # {user_id: set[str]}
+user_search_query: UserStateLRU = _user_state()  # Поисковый запрос
+user_message_ids: UserStateLRU = _user_state()  # ID сообщений для удаления (code_msg, chats_msg)
+user_active_exports: UserStateLRU = _user_state()  # {user_id: {"uuid", "path", "created_monotonic"}} — блокировка повторных выгрузок с файлами
+user_contacts_cache: UserStateLRU = _user_state()  # {user_id: {"contacts", "groups", "private", "hidden"}} — списки чатов (вне FSM)
+user_keyboard_cache: UserStateLRU = _user_state()  # {user_id: {"message_id", "rows", "sn_to_row"}} — последняя клавиатура списка чатов
+user_filter_cache: UserStateLRU = _user_state()  # {user_id: {"key", "source", "filtered"}} — последний результат поиска
+user_clients: UserStateLRU = _user_state()  # {user_id: VKTeamsClient} — один клиент на сессию
+_USER_STATE_DICTS = (
+    user_sessions, user_selected_chats, user_search_query, user_message_ids, user_active_exports,
+    user_contacts_cache, user_keyboard_cache, user_filter_cache, user_clients,
+)
 _files_enabled: bool = True  # Глобальный флаг: файлы доступны всем (загружен из DB при старте)
 _pending_broadcasts: dict[int, str] = {}  # {admin_user_id: broadcast_text} — ожидающие подтверждения
 _files_auto_reenable_at: Optional[float] = None  # epoch — когда автоматически включить файлы (None = нет)
+_upload_semaphore = asyncio.Semaphore(config.MAX_PARALLEL_UPLOADS)  # Одновременные отправки архивов в Telegram
+_broadcast_limiter = AsyncLimiter(config.BROADCAST_RATE_PER_SEC, 1)  # Темп рассылок (поверх общего TelegramRateLimiter)
+_broadcast_tasks: set[asyncio.Task] = set()  # Фоновые рассылки — держим ссылки до завершения
+
+EXPORTS_DIR = "/tmp/vkteams_exports"  # Папки выгрузок файлов (раздаёт stats_server)
+_export_sizes: dict[str, int] = {}  # {export_dir: bytes} — учёт занятого места без обхода диска
+_exports_writing: set[str] = set()  # Папки выгрузок, в которые сейчас идёт загрузка (не чистим)
+EXPORTS_TTL = 600  # Через сколько секунд папка выгрузки считается устаревшей
+
+# Auth-сессии в Redis (если задан REDIS_URL): user_sessions — их кеш в памяти
+_session_store: Optional[RedisSessionStore] = None
+
+
+async def save_session(user_id: int, session: VKTeamsSession):
+    """Запомнить сессию пользователя (в памяти и, если есть, в Redis)"""
+    user_sessions[user_id] = session
+    if _session_store:
+        await _session_store.save(user_id, {
+            "aimsid": session.aimsid,
+            "email": session.email,
+            "fetch_base_url": session.fetch_base_url,
+        })
+
+
+async def drop_session(user_id: int):
+    """Забыть сессию пользователя (в памяти и в Redis, вместе с кешем контактов)"""
+    session = user_sessions.pop(user_id, None)
+    if _session_store:
+        await _session_store.delete(user_id)
+        if session:
+            await _session_store.delete_contacts(session.email)
+
+
+async def restore_session_middleware(handler, event, data):
+    """Подтянуть сессию из Redis, если её нет в памяти (перезапуск, вытеснение LRU)"""
+    user = data.get("event_from_user")
+    if _session_store and user and user.id not in user_sessions:
+        try:
+            stored = await _session_store.load(user.id)
+        except Exception as e:
+            logger.warning("Session restore failed for %s: %s", user.id, e)
+            stored = None
+        if stored:
+            user_sessions[user.id] = VKTeamsSession(**stored)
+    return await handler(event, data)
+
+
+_user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()  # Живёт, пока его держит апдейт
+
+
+def user_lock(user_id: int) -> asyncio.Lock:
+    """Очередь апдейтов пользователя (см. serialize_user_middleware)"""
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+async def serialize_user_middleware(handler, event, data):
+    """Апдейты одного пользователя — строго по очереди
+
+    aiogram обрабатывает каждый апдейт отдельной задачей: без очереди быстрые
+    нажатия одного пользователя перемежаются на общих кешах (выбор чатов,
+    клавиатура). Разные пользователи по-прежнему обрабатываются параллельно.
+    """
+    user = data.get("event_from_user")
+    if user is None:
+        return await handler(event, data)
+    async with user_lock(user.id):
+        return await handler(event, data)
+
+
+router.message.outer_middleware(serialize_user_middleware)
+router.callback_query.outer_middleware(serialize_user_middleware)
+router.message.outer_middleware(restore_session_middleware)
+router.callback_query.outer_middleware(restore_session_middleware)
+
+
+def get_client(user_id: int) -> VKTeamsClient:
+    """Клиент VK Teams для текущей сессии пользователя (создаётся один раз на сессию)"""
+    session = user_sessions.get(user_id)
+    client = user_clients.get(user_id)
+    if client is None or client.session is not session:
+        client = VKTeamsClient(session)
+        user_clients[user_id] = client
+    return client
+
+
+async def get_contacts(user_id: int) -> list:
+    """Список контактов: кеш сессии → кеш в Redis → API VK Teams"""
+    client = get_client(user_id)
+    session = client.session
+    if session.cached_contacts is None and _session_store:
+        try:
+            session.cached_contacts = await _session_store.load_contacts(session.email)
+        except Exception as e:
+            logger.warning("Contacts cache read failed for %s: %s", user_id, e)
+    fetched = session.cached_contacts is None
+
+    contacts = await client.get_contact_list()
+
+    if fetched and contacts and _session_store:
+        try:
+            await _session_store.save_contacts(session.email, contacts, config.CONTACTS_CACHE_TTL)
+        except Exception as e:
+            logger.warning("Contacts cache write failed for %s: %s", user_id, e)
+    return contacts
+
+
+def _dir_size(path: str) -> int:
+    """Суммарный размер файлов в папке (рекурсивно, через scandir)"""
+    total = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                total += _dir_size(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+def recount_export_sizes():
+    """Полный пересчёт занятого экспортами места (один раз при старте)"""
+    _export_sizes.clear()
+    if not os.path.isdir(EXPORTS_DIR):
+        return
+    with os.scandir(EXPORTS_DIR) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                _export_sizes[entry.path] = _dir_size(entry.path)
+
+
+def exports_used_bytes() -> int:
+    """Занятое экспортами место по учёту в памяти
+
+    Папки по TTL удаляет и stats_server, поэтому записи об исчезнувших
+    папках отбрасываем: один stat на выгрузку, а не на каждый файл.
+    """
+    for path in [p for p in _export_sizes if not os.path.isdir(p)]:
+        del _export_sizes[path]
+    return sum(_export_sizes.values())
+
+
+async def remove_export_dir(path: str):
+    """Удалить папку выгрузки (в потоке) и снять её с учёта места"""
+    await asyncio.to_thread(shutil.rmtree, path, True)
+    _export_sizes.pop(path, None)
+
+
+async def _exports_janitor(interval: float = 120):
+    """Фоновая очистка устаревших выгрузок файлов (вне пути экспорта)
+
+    Заодно вытесняет просроченное состояние пользователей: сами словари делают
+    это только при вставке, а без новых пользователей записи висели бы до неё.
+    """
+    while True:
+        try:
+            for state_dict in _USER_STATE_DICTS:
+                state_dict.evict_expired()
+            if os.path.isdir(EXPORTS_DIR):
+                now_ts = time.time()  # Сравниваем с mtime — нужны настенные часы
+                with os.scandir(EXPORTS_DIR) as it:
+                    stale = [
+                        entry for entry in it
+                        if entry.is_dir(follow_symlinks=False)
+                        and entry.path not in _exports_writing
+                        and now_ts - entry.stat().st_mtime > EXPORTS_TTL
+                    ]
+                for entry in stale:
+                    await remove_export_dir(entry.path)
+                    logger.info("Cleaned up old export: %s", entry.name)
+        except Exception as e:
+            logger.warning("Exports janitor error: %s", e)
+        await asyncio.sleep(interval)
+
 
 def make_progress_bar(current: int, total: int, width: int = 20) -> str:
     """Создать текстовый прогресс-бар"""
@@ -97,9 +313,62 @@ async def safe_edit_text(message, text: str, **kwargs):
         if "message is not modified" not in str(e):
             raise
     except TelegramRetryAfter as e:
-        print(f"⚠️ Telegram flood control: retry after {e.retry_after}s, skipping update")
+        logger.warning("Telegram flood control: retry after %ss, skipping update", e.retry_after)
     except TelegramServerError as e:
-        print(f"⚠️ Telegram server error: {e}, skipping update")
+        logger.warning("Telegram server error: %s, skipping update", e)
+
+
+class StatusWriter:
+    """Единственный писатель статус-сообщения долгой операции
+
+    Очередь на один элемент: новый текст вытесняет ещё не показанный, так что
+    промежуточные состояния отбрасываются, а правки идут не чаще interval секунд.
+    Flood control (retry_after) обрабатывает TelegramRateLimiter.
+    """
+
+    def __init__(self, message, interval: float = 1.2):
+        self.message = message
+        self.interval = interval
+        self._queue = asyncio.Queue(maxsize=1)
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    def update(self, text: str, **kwargs):
+        """Поставить новый текст статуса, не дожидаясь отправки"""
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait((text, kwargs))
+
+    async def close(self):
+        """Показать последнее поставленное обновление и остановить писателя
+
+        Повторный вызов (и вызов после падения писателя) ничего не делает.
+        """
+        if self._task.done():
+            return
+        self._closing = True
+        if self._queue.empty():
+            self._queue.put_nowait(None)  # Показывать больше нечего — будим писателя
+        await self._task
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            text, kwargs = item
+            try:
+                await self.message.edit_text(text, **kwargs)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    logger.warning("Status edit failed: %s", e)
+            except Exception as e:
+                logger.warning("Status edit failed: %s", e)
+            if self._closing:
+                if self._queue.empty():
+                    return  # Последнее обновление показано
+                continue  # Закрываемся — последний текст без паузы
+            await asyncio.sleep(self.interval)
 
 
 async def safe_edit_reply_markup(message, **kwargs):
@@ -119,6 +388,51 @@ async def safe_delete_message(bot: Bot, chat_id: int, message_id: int):
         pass
 
 
+async def safe_delete_messages(bot: Bot, chat_id: int, message_ids: list[int]):
+    """Safely delete messages in batches (deleteMessages, up to 100 per call), ignoring errors"""
+    for i in range(0, len(message_ids), 100):
+        batch = message_ids[i:i + 100]
+        try:
+            await bot.delete_messages(chat_id, batch)
+        except:
+            # Батч не прошёл — удаляем по одному, но параллельно
+            await asyncio.gather(*(safe_delete_message(bot, chat_id, mid) for mid in batch), return_exceptions=True)
+
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    """Общий темп исходящих сообщений бота и глобальная пауза на flood control
+
+    Отправки и правки всех хендлеров идут через один token bucket. Получив
+    retry_after, останавливаем все отправки на этот срок (а не только упавший
+    запрос) и повторяем запрос после паузы.
+    """
+
+    _LIMITED = ("Send", "Edit", "Copy", "Forward")
+
+    def __init__(self, rate: float, max_retries: int = 3):
+        self._limiter = AsyncLimiter(rate, 1)
+        self._resume_at = 0.0  # time.monotonic(), до которого отправки приостановлены
+        self.max_retries = max_retries
+
+    async def __call__(self, make_request, bot, method):
+        # answerCallbackQuery, deleteMessage и т.п. в лимит сообщений не входят
+        if not type(method).__name__.startswith(self._LIMITED):
+            return await make_request(bot, method)
+
+        for attempt in range(self.max_retries + 1):
+            delay = self._resume_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self._limiter:
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self._resume_at = max(self._resume_at, time.monotonic() + e.retry_after)
+                    logger.warning("Telegram flood control on %s: pausing sends for %ss", type(method).__name__, e.retry_after)
+
+
 async def send_document_with_retry(
     bot: Bot,
     chat_id: int,
@@ -126,26 +440,32 @@ async def send_document_with_retry(
     caption: str,
     max_retries: int = 4
 ) -> bool:
-    """Отправить документ с retry логикой и exponential backoff"""
+    """Отправить документ с retry логикой и exponential backoff
+
+    Flood control (retry_after) обрабатывает TelegramRateLimiter, здесь — только сетевые сбои.
+    """
     last_error = None
 
     for attempt in range(max_retries):
         try:
-            await bot.send_document(
-                chat_id,
-                FSInputFile(file_path),
-                caption=caption,
-                request_timeout=300,  # 5 минут на загрузку
-            )
+            # Ограничиваем число одновременных загрузок в Telegram по всем пользователям
+            async with _upload_semaphore:
+                await bot.send_document(
+                    chat_id,
+                    FSInputFile(file_path, chunk_size=config.UPLOAD_CHUNK_SIZE),
+                    caption=caption,
+                    request_timeout=300,  # 5 минут на загрузку
+                )
             return True
-        except (asyncio.TimeoutError, TelegramNetworkError) as e:
+        except (asyncio.TimeoutError, TelegramNetworkError, TelegramServerError) as e:
             last_error = e
             if attempt < max_retries - 1:
-                wait_time = 2 ** (attempt + 1)  # 2, 4, 8, 16 seconds
-                print(f"📤 Retry {attempt + 1}/{max_retries} after {wait_time}s: {e}")
+                # Экспоненциальная пауза с джиттером, чтобы повторы разных пользователей не совпадали
+                wait_time = min(30.0, 2.0 * 2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning("Send document retry %d/%d after %.1fs: %s", attempt + 1, max_retries, wait_time, e)
                 await asyncio.sleep(wait_time)
         except Exception as e:
-            # Non-retryable error
+            # Non-retryable error (TelegramBadRequest, слишком большой файл и т.п.)
             raise
 
     # All retries failed
@@ -161,45 +481,35 @@ async def cleanup_user_messages(bot: Bot, user_id: int, chat_id: int, msg_type:
             await safe_delete_message(bot, chat_id, msgs[msg_type])
             del msgs[msg_type]
     else:
-        # Удаляем все
-        for msg_id in msgs.values():
-            await safe_delete_message(bot, chat_id, msg_id)
+        # Удаляем все одним запросом
+        await safe_delete_messages(bot, chat_id, list(msgs.values()))
         user_message_ids[user_id] = {}
 
 
-def is_hidden_chat(name: str) -> bool:
-    """Проверить, является ли чат скрытым (ДР, свадьба, поздравления и т.п.)"""
-    import re
-    name_lower = name.lower()
-
-    # "день рождения" или "день рождение" (с опечаткой)
-    if 'день рождени' in name_lower:
-        return True
-
-    # Рождение сына/дочери
-    if 'рождени' in name_lower and ('сын' in name_lower or 'дочь' in name_lower or 'дочер' in name_lower):
-        return True
+# Недопустимые в именах файлов символы → "_" за один проход str.translate
+_SANITIZE = str.maketrans({c: "_" for c in '/\\:*?"<>|'})
 
-    # Поздравление/поздравления
-    if 'поздравлен' in name_lower:
-        return True
 
-    # Свадьба, женился/женилась
-    if 'свадьб' in name_lower:
-        return True
-    if 'женил' in name_lower:
-        return True
+# Ключевые слова скрытых чатов одной регуляркой (компилируется один раз при импорте)
+_HIDDEN_RE = re.compile(
+    r'день рождени'                                   # "день рождения" / "день рождение" (с опечаткой)
+    r'|рождени.*(?:сын|дочь|дочер)'                   # Рождение сына/дочери
+    r'|(?:сын|дочь|дочер).*рождени'
+    r'|поздравлен'                                    # Поздравление/поздравления
+    r'|свадьб|женил'                                  # Свадьба, женился/женилась
+    r'|стал отцом|стала мамой'                        # Стал отцом / стала мамой
+    r'|(?<![а-яёa-z])др(?![а-яёa-z])',                # Целое слово "др"
+    re.DOTALL,
+)
 
-    # Стал отцом / стала мамой
-    if 'стал отцом' in name_lower or 'стала мамой' in name_lower:
-        return True
 
-    # Целое слово "др" - проверяем что перед и после нет кириллических букв
-    pattern = r'(?<![а-яёa-z])др(?![а-яёa-z])'
-    if re.search(pattern, name_lower):
-        return True
+@lru_cache(maxsize=4096)
+def is_hidden_chat(name: str) -> bool:
+    """Проверить, является ли чат скрытым (ДР, свадьба, поздравления и т.п.)
 
-    return False
+    Одни и те же названия чатов встречаются у многих пользователей — результат мемоизируем.
+    """
+    return _HIDDEN_RE.search(name.lower()) is not None
 
 
 def is_unnamed_chat(chat: dict) -> bool:
@@ -218,15 +528,196 @@ def is_unnamed_chat(chat: dict) -> bool:
     return True
 
 
-# ============== Handlers ==============
+def _truncate(text: str, limit: int) -> str:
+    """Обрезать строку до limit символов с «…»"""
+    return text if len(text) <= limit else text[:limit] + "…"
 
-@router.message(Command("start"))
-async def cmd_start(message: Message):
-    """Приветствие и инструкция"""
-    log_event("start", message.from_user.id)
-    update_active_user(message.from_user.id, message.from_user.username)
 
-    text = f"""
+def chat_display_name(chat: dict) -> str:
+    """Подпись кнопки чата (без чекбокса) — считается один раз при классификации"""
+    sn = chat.get("sn", "")
+    name = chat.get("name") or chat.get("friendly") or sn
+
+    # Определяем удалённых пользователей: имя = email или есть is_blocked
+    is_deleted = chat.get("is_blocked", False) or (name == sn and "@" in sn and "@chat.agent" not in sn)
+
+    if is_deleted:
+        # Показываем email с пометкой
+        return f"👤❌ {_truncate(sn or name, 23)}"
+    return _truncate(name, 28)
+
+
+def classify_contacts(contacts: list) -> dict:
+    """Разделить контакты на группы / личные / скрытые и посчитать статистику"""
+    # Один проход по контактам: признаки считаются один раз и кэшируются прямо в dict,
+    # контакт сразу раскладывается в свою корзину (безымянные дубли пропускаем)
+    groups, hidden_groups, private, hidden_private = [], [], [], []
+    with_messages_count = deleted_count = 0
+    buckets = {(True, False): groups, (True, True): hidden_groups,
+               (False, False): private, (False, True): hidden_private}
+    for c in contacts:
+        sn = c.get("sn", "")
+        name = c.get("name", "")
+        c["_is_group"] = "@chat.agent" in sn
+        c["_unnamed"] = is_unnamed_chat(c)
+        c["_hidden"] = is_hidden_chat(name or c.get("friendly", "") or sn)
+        c["_has_msgs"] = bool(c.get("has_messages"))
+        c["_search_key"] = (name or sn).lower()
+        # Удалённый: is_blocked или имя = email
+        c["_deleted"] = bool(c.get("is_blocked")) or (name == sn and "@" in sn and not c["_is_group"])
+        c["_sn"] = sn
+        c["_display"] = chat_display_name(c)
+        if c["_unnamed"]:
+            continue
+        buckets[c["_is_group"], c["_hidden"]].append(c)
+        # Статистика — по видимым личным чатам
+        if not c["_is_group"] and not c["_hidden"]:
+            with_messages_count += c["_has_msgs"]
+            deleted_count += c["_deleted"]
+
+    # Личные чаты - все контакты из buddylist (не только с has_messages)
+    # Сортируем: сначала с перепиской, потом остальные (скрытые — в том же порядке)
+    private_key = lambda c: (not c["_has_msgs"], c.get("name", "").lower())
+    private.sort(key=private_key)
+    hidden_private.sort(key=private_key)
+    hidden = hidden_groups + hidden_private
+
+    return {
+        "contacts": contacts, "groups": groups, "private": private, "hidden": hidden,
+        "with_messages_count": with_messages_count, "deleted_count": deleted_count,
+        # Параллельные списки ключей поиска — фильтр идёт по строкам, без обращений к dict
+        "search_index": {
+            "groups": [c["_search_key"] for c in groups],
+            "private": [c["_search_key"] for c in private],
+            "hidden": [c["_search_key"] for c in hidden],
+        },
+        # Параллельные списки sn — «Выбрать все» без поиска добавляет их целиком
+        "sn_index": {
+            "groups": [c["_sn"] for c in groups],
+            "private": [c["_sn"] for c in private],
+            "hidden": [c["_sn"] for c in hidden],
+        },
+    }
+
+
+# ============== Export files (блокирующие, вызываются через asyncio.to_thread) ==============
+
+class _HtmlRenderError(Exception):
+    """Ошибка генерации HTML при сборке архива (архив пересобирается со страницей ошибки)"""
+
+
+def write_json_member(out, data: dict):
+    """JSON экспорта в бинарный поток (участник ZIP) — потоково, по одному чату"""
+    write_json(data, out)
+
+
+def write_html_member(out, data: dict, **kwargs):
+    """HTML экспорта в бинарный поток (участник ZIP) — потоково, по одному сообщению"""
+    # newline="" — без перевода концов строк в текстовом слое
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+    try:
+        write_html(data, text, **kwargs)
+    except Exception as e:
+        raise _HtmlRenderError(e) from e
+    finally:
+        text.detach()  # Дописывает буфер, но не закрывает участника — его закрывает build_export_zip
+
+
+def write_text_member(out, text: str):
+    """Готовый текст в бинарный поток (участник ZIP)"""
+    out.write(text.encode("utf-8"))
+
+
+def make_dirs(paths: list[str]):
+    """Создать папки (exist_ok)"""
+    for path in paths:
+        os.makedirs(path, exist_ok=True)
+
+
+def _zip_member_info(zf: zipfile.ZipFile, arcname: str, date_time: tuple) -> zipfile.ZipInfo:
+    """ZipInfo участника с датой архива (а не 1980-01-01, как при открытии по имени) и сжатием архива"""
+    zinfo = zipfile.ZipInfo(arcname, date_time=date_time)
+    zinfo.external_attr = 0o644 << 16
+    zinfo.compress_type = zf.compression
+    zinfo._compresslevel = zf.compresslevel
+    return zinfo
+
+
+def estimate_export_size(data: dict, avatars: dict = None) -> int:
+    """Грубая верхняя оценка несжатого размера участника экспорта (JSON или HTML), байт
+
+    Текст сообщений с запасом на экранирование, разметку и служебные поля плюс
+    аватарки в base64. Нужна только чтобы zipfile заранее выбрал ZIP64 (> 2 ГБ).
+    """
+    size = 256 * 1024  # Шаблон страницы: стили, скрипты, список чатов
+    for chat in data.get("chats", ()):
+        for msg in chat.get("messages", ()):
+            size += 2048 + 2 * len(msg.get("text") or "")
+            for part in msg.get("parts") or ():
+                caption = (part.get("captionedContent") or {}).get("caption")
+                size += 2 * (len(str(part.get("text") or "")) + len(str(caption or "")))
+            size += 512 * len(msg.get("filesharing") or ())
+    if avatars:
+        size += sum(len(a) for a in avatars.values()) * 4 // 3
+    return size
+
+
+def build_export_zip(zip_path: str, members: list, compresslevel: Optional[int]) -> int:
+    """Собрать ZIP экспорта [(arcname, write, size_hint)]: write(out) пишет участника прямо в сжатый поток
+
+    Без промежуточных файлов: содержимое сериализуется, сжимается и пишется на диск
+    за один проход. size_hint — известный или оценочный несжатый размер участника:
+    по нему zipfile заранее решает, нужен ли ZIP64. Возвращает суммарный несжатый размер.
+    """
+    total = 0
+    date_time = time.localtime()[:6]  # Одно время на весь архив
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel, allowZip64=True) as zf:
+        for arcname, write, size_hint in members:
+            zinfo = _zip_member_info(zf, arcname, date_time)
+            zinfo.file_size = size_hint  # После записи zipfile заменит на фактический
+            with zf.open(zinfo, "w") as out:
+                write(out)
+            total += zinfo.file_size
+    return total
+
+
+def recompress_zip(zip_path: str, compresslevel: Optional[int], buffer_size: int = 1024 * 1024):
+    """Пережать готовый архив с другим уровнем сжатия (на месте)
+
+    Участники распаковываются из исходного архива потоком — содержимое
+    экспорта заново не генерируется.
+    """
+    tmp_path = zip_path + ".recompress"
+    try:
+        with zipfile.ZipFile(zip_path) as src, \
+                zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel, allowZip64=True) as dst:
+            for info in src.infolist():
+                # Дата участника сохраняется, а по известному размеру zipfile сам решает, нужен ли ZIP64
+                zinfo = _zip_member_info(dst, info.filename, info.date_time)
+                zinfo.file_size = info.file_size
+                with src.open(info) as fin, dst.open(zinfo, "w") as fout:
+                    shutil.copyfileobj(fin, fout, buffer_size)
+        os.replace(tmp_path, zip_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def zip_append_file(zf: zipfile.ZipFile, file_path: str, arcname: str, buffer_size: int = 1024 * 1024):
+    """Дописать файл в открытый ZIP одним проходом с большим буфером"""
+    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+    zinfo.compress_type = zf.compression
+    with open(file_path, "rb") as src, zf.open(zinfo, "w") as dest:
+        shutil.copyfileobj(src, dest, buffer_size)
+
+
+# ============== Handlers ==============
+
+# Статичные тексты собираются один раз при импорте
+_START_TEXT = f"""
 📦 <b>VK Teams Export Bot</b>
 
 Данный бот предназначен для экспорта чатов из VK Teams.
@@ -245,13 +736,8 @@ async def cmd_start(message: Message):
 
 По всем вопросам и при возникновении ошибок обращайтесь: <code>{SUPPORT_CONTACT}</code>
 """
-    await message.answer(text, parse_mode="HTML")
-
 
-@router.message(Command("help"))
-async def cmd_help(message: Message):
-    """Подробная инструкция"""
-    text = f"""
+_HELP_TEXT = f"""
 📖 <b>Справка по использованию</b>
 
 <b>Авторизация:</b>
@@ -275,7 +761,27 @@ async def cmd_help(message: Message):
 
 По вопросам: <code>{SUPPORT_CONTACT}</code>
 """
-    await message.answer(text, parse_mode="HTML")
+
+_AUTH_PROMPT_TEXT = """
+🔐 <b>Авторизация в VK Teams</b>
+
+Введите вашу корпоративную почту:
+"""
+
+
+@router.message(Command("start"))
+async def cmd_start(message: Message):
+    """Приветствие и инструкция"""
+    log_event("start", message.from_user.id)
+    update_active_user(message.from_user.id, message.from_user.username)
+
+    await message.answer(_START_TEXT, parse_mode="HTML")
+
+
+@router.message(Command("help"))
+async def cmd_help(message: Message):
+    """Подробная инструкция"""
+    await message.answer(_HELP_TEXT, parse_mode="HTML")
 
 
 @router.message(Command("auth"))
@@ -299,12 +805,7 @@ async def cmd_auth(message: Message, state: FSMContext):
         )
         return
 
-    text = """
-🔐 <b>Авторизация в VK Teams</b>
-
-Введите вашу корпоративную почту:
-"""
-    await message.answer(text, parse_mode="HTML")
+    await message.answer(_AUTH_PROMPT_TEXT, parse_mode="HTML")
     await state.set_state(AuthStates.waiting_email)
 
 
@@ -319,9 +820,13 @@ async def cmd_logout(message: Message, state: FSMContext):
 
     email = session.email
     # Очищаем данные
-    user_sessions.pop(message.from_user.id, None)
+    await drop_session(message.from_user.id)
     user_selected_chats.pop(message.from_user.id, None)
     user_search_query.pop(message.from_user.id, None)
+    user_keyboard_cache.pop(message.from_user.id, None)
+    user_contacts_cache.pop(message.from_user.id, None)
+    user_filter_cache.pop(message.from_user.id, None)
+    user_clients.pop(message.from_user.id, None)
     await state.clear()
 
     # Удаляем старые сообщения со списком чатов
@@ -337,7 +842,6 @@ async def cmd_logout(message: Message, state: FSMContext):
     )
 
 
-@router.callback_query(F.data == "do_logout")
 async def handle_logout(callback: CallbackQuery, state: FSMContext):
     """Обработка кнопки логаута"""
     # Отвечаем на callback сразу
@@ -347,9 +851,13 @@ async def handle_logout(callback: CallbackQuery, state: FSMContext):
     email = session.email if session else "?"
 
     # Очищаем данные
-    user_sessions.pop(callback.from_user.id, None)
+    await drop_session(callback.from_user.id)
     user_selected_chats.pop(callback.from_user.id, None)
     user_search_query.pop(callback.from_user.id, None)
+    user_keyboard_cache.pop(callback.from_user.id, None)
+    user_contacts_cache.pop(callback.from_user.id, None)
+    user_filter_cache.pop(callback.from_user.id, None)
+    user_clients.pop(callback.from_user.id, None)
     await state.clear()
 
     # Удаляем старые сообщения
@@ -365,7 +873,6 @@ async def handle_logout(callback: CallbackQuery, state: FSMContext):
     )
 
 
-@router.callback_query(F.data == "go_to_chats")
 async def handle_go_to_chats(callback: CallbackQuery, state: FSMContext):
     """Перейти к чатам из меню авторизации"""
     # Отвечаем на callback сразу
@@ -445,11 +952,10 @@ async def process_code(message: Message, state: FSMContext):
         auth = VKTeamsAuth()
         session = await auth.verify_code(email, code)
 
-        user_sessions[message.from_user.id] = session
+        await save_session(message.from_user.id, session)
 
-        # Проверяем работоспособность
-        client = VKTeamsClient(session)
-        contacts = await client.get_contact_list()
+        # Проверяем работоспособность (заодно прогреваем кеш контактов)
+        contacts = await get_contacts(message.from_user.id)
 
         log_event("auth_success", message.from_user.id, email)
         update_active_user(message.from_user.id, message.from_user.username, email)
@@ -496,43 +1002,32 @@ async def cmd_chats(message: Message, state: FSMContext):
     status_msg = await message.answer("⏳ Загружаем список чатов...")
 
     try:
-        client = VKTeamsClient(session)
-        contacts = await client.get_contact_list()
+        contacts = await get_contacts(message.from_user.id)
 
         if not contacts:
             await safe_edit_text(status_msg, "📭 Чаты не найдены")
             return
 
-        # Разделяем на группы и личные чаты (без безымянных дублей)
-        all_groups = [c for c in contacts if "@chat.agent" in c.get("sn", "") and not is_unnamed_chat(c)]
-        # Личные чаты - все контакты из buddylist (не только с has_messages)
-        # Сортируем: сначала с перепиской, потом остальные
-        all_private_unsorted = [c for c in contacts if "@chat.agent" not in c.get("sn", "") and not is_unnamed_chat(c)]
-        all_private = sorted(all_private_unsorted, key=lambda c: (not c.get("has_messages", False), c.get("name", "").lower()))
-
-        # Фильтруем скрытые (ДР, свадьба и т.п.) из обеих категорий
-        hidden_groups = [c for c in all_groups if is_hidden_chat(c.get("name", "") or c.get("friendly", "") or c.get("sn", ""))]
-        hidden_private = [c for c in all_private if is_hidden_chat(c.get("name", "") or c.get("friendly", "") or c.get("sn", ""))]
-        hidden = hidden_groups + hidden_private
-
-        groups = [c for c in all_groups if not is_hidden_chat(c.get("name", "") or c.get("friendly", "") or c.get("sn", ""))]
-        private = [c for c in all_private if not is_hidden_chat(c.get("name", "") or c.get("friendly", "") or c.get("sn", ""))]
-
-        # Count stats
-        with_messages_count = len([c for c in private if c.get("has_messages")])
-        # Считаем удалённых: is_blocked или имя = email
-        deleted_count = len([c for c in private if c.get("is_blocked") or (c.get("name") == c.get("sn") and "@" in c.get("sn", "") and "@chat.agent" not in c.get("sn", ""))])
-
-        # Сохраняем для выбора (сначала группы)
-        await state.update_data(contacts=contacts, groups=groups, private=private, hidden=hidden)
+        # Список контактов кэшируется на сессии — повторный /chats не пересчитывает классификацию
+        chat_lists = user_contacts_cache.get(message.from_user.id)
+        if chat_lists is None or chat_lists["contacts"] is not contacts:
+            chat_lists = classify_contacts(contacts)
+            # Сохраняем для выбора — в памяти процесса, в FSM только лёгкие ключи
+            user_contacts_cache[message.from_user.id] = chat_lists
+        groups = chat_lists["groups"]
+        private = chat_lists["private"]
+        hidden = chat_lists["hidden"]
+        with_messages_count = chat_lists["with_messages_count"]
+        deleted_count = chat_lists["deleted_count"]
 
         # Инициализируем выбранные чаты и состояние
-        user_selected_chats[message.from_user.id] = []
+        user_selected_chats[message.from_user.id] = set()
         user_search_query[message.from_user.id] = ""
         await state.update_data(current_page=0, current_mode="groups")
 
         # Формируем клавиатуру с чекбоксами
-        keyboard = build_chats_keyboard(groups, [], page=0, mode="groups", has_hidden=len(hidden) > 0)
+        keyboard = build_chats_keyboard(groups, set(), page=0, mode="groups", has_hidden=len(hidden) > 0)
+        remember_chats_keyboard(message.from_user.id, status_msg.message_id, keyboard, shown=True)
 
         hidden_text = f"\n🎂 Скрытых (ДР/свадьба): {len(hidden)}" if hidden else ""
         deleted_text = f" (👤❌ удалённых: {deleted_count})" if deleted_count else ""
@@ -562,47 +1057,110 @@ async def cmd_chats(message: Message, state: FSMContext):
         )
 
 
+# Мемоизация build_chats_keyboard: {(id(chats), page, page_size, mode, has_hidden, search_query, frozenset(selected)): (chats, markup)}
+# Разметка aiogram неизменяемая, поэтому один объект безопасно отдавать повторно
+_keyboard_memo: OrderedDict = OrderedDict()
+_KEYBOARD_MEMO_SIZE = 256
+
+
+def filter_chats(chats: list, search_query: str, user_id: Optional[int] = None, mode: str = "") -> list:
+    """Отфильтровать чаты по поиску (результат кэшируется по (user_id, mode, search_query))
+
+    Уточняющий запрос фильтрует прошлый результат, а не весь список.
+    """
+    if not search_query:
+        return chats
+    search_lower = search_query.lower()
+    if user_id is None:
+        return [c for c in chats if search_lower in c["_search_key"]]
+
+    key = (mode, search_lower)
+    cached = user_filter_cache.get(user_id)
+    # Список тот же объект — значит /chats не перезагружался и фильтр актуален
+    if cached and cached["key"] == key and cached["source"] is chats:
+        return cached["filtered"]
+
+    chat_lists = user_contacts_cache.get(user_id) or {}
+    if cached and cached["source"] is chats and cached["key"][0] == mode and cached["key"][1] in search_lower:
+        # Новый запрос уточняет прошлый («фо» → «фон») — всё найденное уже в прошлом результате
+        filtered = [c for c in cached["filtered"] if search_lower in c["_search_key"]]
+    elif chat_lists.get(mode) is chats:
+        index = chat_lists["search_index"][mode]
+        filtered = [c for c, search_key in zip(chats, index) if search_lower in search_key]
+    else:
+        filtered = [c for c in chats if search_lower in c["_search_key"]]
+    user_filter_cache[user_id] = {"key": key, "source": chats, "filtered": filtered}
+    return filtered
+
+
+# Постоянные кнопки клавиатуры списка чатов: разметка aiogram неизменяемая,
+# поэтому одни и те же объекты переиспользуются во всех клавиатурах
+_BTN_CLEAR_SELECTION = InlineKeyboardButton(text="❌ Сбросить", callback_data="clear_selection")
+_BTN_SEARCH = InlineKeyboardButton(text="🔍 Поиск", callback_data="start_search")
+_BTN_CLEAR_SEARCH = InlineKeyboardButton(text="🚫 Сброс поиска", callback_data="clear_search")
+_BTN_FILLER = InlineKeyboardButton(text=" ", callback_data="noop")
+_BTN_SELECT_ALL = {
+    mode: InlineKeyboardButton(text="✅ Выбрать все", callback_data=f"select_all:{mode}")
+    for mode in ("groups", "private", "hidden")
+}
+_BTN_SHOW_GROUPS = InlineKeyboardButton(text="👥 Группы", callback_data="show_groups")
+_BTN_SHOW_HIDDEN = InlineKeyboardButton(text="🎂 Скрытые", callback_data="show_hidden")
+# Ряд переключения режимов: {(mode, has_hidden): (кнопки...)}
+_MODE_NAV_ROWS = {
+    ("groups", False): (InlineKeyboardButton(text="👤 Личные чаты", callback_data="show_private"),),
+    ("private", False): (_BTN_SHOW_GROUPS,),
+    ("hidden", False): (_BTN_SHOW_GROUPS, InlineKeyboardButton(text="👤 Личные", callback_data="show_private")),
+}
+_MODE_NAV_ROWS[("groups", True)] = _MODE_NAV_ROWS[("groups", False)] + (_BTN_SHOW_HIDDEN,)
+_MODE_NAV_ROWS[("private", True)] = _MODE_NAV_ROWS[("private", False)] + (_BTN_SHOW_HIDDEN,)
+_MODE_NAV_ROWS[("hidden", True)] = _MODE_NAV_ROWS[("hidden", False)]
+
+
+def _select_all_button(mode: str) -> InlineKeyboardButton:
+    """Кнопка «Выбрать все» для режима (для неизвестного режима — новая)"""
+    button = _BTN_SELECT_ALL.get(mode)
+    if button is None:
+        button = InlineKeyboardButton(text="✅ Выбрать все", callback_data=f"select_all:{mode}")
+    return button
+
+
 def build_chats_keyboard(
     chats: list,
-    selected: list,
+    selected: set,
     page: int = 0,
     page_size: int = 30,
     mode: str = "groups",
     has_hidden: bool = False,
-    search_query: str = ""
+    search_query: str = "",
+    user_id: Optional[int] = None
 ) -> InlineKeyboardMarkup:
-    """Построить клавиатуру с чекбоксами и пагинацией"""
+    """Построить клавиатуру с чекбоксами и пагинацией (результат мемоизируется)"""
+    source_chats = chats
+    cache_key = (id(chats), page, page_size, mode, has_hidden, search_query, frozenset(selected))
+    cached = _keyboard_memo.get(cache_key)
+    if cached and cached[0] is source_chats:
+        _keyboard_memo.move_to_end(cache_key)
+        return cached[1]
+
     builder = InlineKeyboardBuilder()
 
     # Фильтрация по поиску
-    if search_query:
-        search_lower = search_query.lower()
-        chats = [c for c in chats if search_lower in (c.get("name", "") or c.get("sn", "")).lower()]
+    chats = filter_chats(chats, search_query, user_id=user_id, mode=mode)
 
     total = len(chats)
     start = page * page_size
     end = min(start + page_size, total)
     page_chats = chats[start:end]
 
+    buttons = []
     for chat in page_chats:
-        sn = chat.get("sn", "")
-        name = chat.get("name") or chat.get("friendly") or sn
-
-        # Определяем удалённых пользователей: имя = email или есть is_blocked
-        is_deleted = chat.get("is_blocked", False) or (name == sn and "@" in sn and "@chat.agent" not in sn)
-
-        if is_deleted:
-            # Показываем email с пометкой
-            display_name = sn if sn else name
-            display_name = display_name[:23] + "…" if len(display_name) > 23 else display_name
-            display_name = f"👤❌ {display_name}"
-        else:
-            display_name = name[:28] + "…" if len(name) > 28 else name
-
+        sn = chat["_sn"]
         # Чекбокс
         checkbox = "☑️" if sn in selected else "⬜"
-        builder.button(text=f"{checkbox} {display_name}", callback_data=f"select:{sn}")
+        buttons.append(InlineKeyboardButton(text=f"{checkbox} {chat['_display']}", callback_data=f"select:{sn}"))
 
+    # Кнопки чатов — одним вызовом, по одной в ряд
+    builder.add(*buttons)
     builder.adjust(1)
 
     # Пагинация
@@ -617,41 +1175,98 @@ def build_chats_keyboard(
         builder.row(*nav_buttons)
 
     # Кнопки управления
-    builder.row(
-        InlineKeyboardButton(text="✅ Выбрать все", callback_data=f"select_all:{mode}"),
-        InlineKeyboardButton(text="❌ Сбросить", callback_data="clear_selection"),
-    )
+    builder.row(_select_all_button(mode), _BTN_CLEAR_SELECTION)
 
     # Поиск
-    search_btn_text = f"🔍 Поиск: {search_query[:15]}..." if search_query else "🔍 Поиск"
-    builder.row(
-        InlineKeyboardButton(text=search_btn_text, callback_data="start_search"),
-        InlineKeyboardButton(text="🚫 Сброс поиска", callback_data="clear_search") if search_query else InlineKeyboardButton(text=" ", callback_data="noop"),
-    )
+    if search_query:
+        builder.row(
+            InlineKeyboardButton(text=f"🔍 Поиск: {search_query[:15]}...", callback_data="start_search"),
+            _BTN_CLEAR_SEARCH,
+        )
+    else:
+        builder.row(_BTN_SEARCH, _BTN_FILLER)
 
     # Переключение между группами, личными и скрытыми
-    nav_row = []
-    if mode == "groups":
-        nav_row.append(InlineKeyboardButton(text="👤 Личные чаты", callback_data="show_private"))
-        if has_hidden:
-            nav_row.append(InlineKeyboardButton(text="🎂 Скрытые", callback_data="show_hidden"))
-    elif mode == "private":
-        nav_row.append(InlineKeyboardButton(text="👥 Группы", callback_data="show_groups"))
-        if has_hidden:
-            nav_row.append(InlineKeyboardButton(text="🎂 Скрытые", callback_data="show_hidden"))
-    elif mode == "hidden":
-        nav_row.append(InlineKeyboardButton(text="👥 Группы", callback_data="show_groups"))
-        nav_row.append(InlineKeyboardButton(text="👤 Личные", callback_data="show_private"))
-    builder.row(*nav_row)
+    builder.row(*_MODE_NAV_ROWS.get((mode, has_hidden), ()))
 
     builder.row(
         InlineKeyboardButton(text=f"📥 Экспорт ({len(selected)} шт.)", callback_data="do_export"),
     )
 
-    return builder.as_markup()
+    keyboard = builder.as_markup()
+    _keyboard_memo[cache_key] = (source_chats, keyboard)
+    if len(_keyboard_memo) > _KEYBOARD_MEMO_SIZE:
+        _keyboard_memo.popitem(last=False)
+    return keyboard
+
+
+def remember_chats_keyboard(user_id: int, message_id: int, keyboard: InlineKeyboardMarkup, shown: bool = False):
+    """Запомнить отрисованную клавиатуру, чтобы переключать чекбоксы без полной перестройки
+
+    shown=True — клавиатура уходит в сообщение вместе с текстом (answer/edit_text
+    с reply_markup); иначе сохраняется прежний снимок — его сверит update_chats_keyboard.
+    """
+    previous = user_keyboard_cache.get(user_id)
+    if shown:
+        shown_key = _markup_key(keyboard)
+    elif previous and previous["message_id"] == message_id:
+        shown_key = previous.get("shown")
+    else:
+        shown_key = None
+    rows = [list(row) for row in keyboard.inline_keyboard]
+    sn_to_row = {
+        row[0].callback_data[len("select:"):]: i
+        for i, row in enumerate(rows)
+        if row and (row[0].callback_data or "").startswith("select:")
+    }
+    user_keyboard_cache[user_id] = {"message_id": message_id, "rows": rows, "sn_to_row": sn_to_row, "shown": shown_key}
+
+
+def toggle_cached_keyboard(user_id: int, message_id: int, sn: str, selected) -> Optional[InlineKeyboardMarkup]:
+    """Переключить чекбокс одного чата в закэшированной клавиатуре (None — кэша нет, нужна перестройка)"""
+    cached = user_keyboard_cache.get(user_id)
+    if not cached or cached["message_id"] != message_id:
+        return None
+    row_idx = cached["sn_to_row"].get(sn)
+    if row_idx is None:
+        return None
+
+    rows = cached["rows"]
+    button = rows[row_idx][0]
+    checkbox = "☑️" if sn in selected else "⬜"
+    rows[row_idx][0] = InlineKeyboardButton(text=f"{checkbox} {button.text.split(' ', 1)[1]}", callback_data=button.callback_data)
+    # Кнопка экспорта всегда последняя
+    rows[-1][0] = InlineKeyboardButton(text=f"📥 Экспорт ({len(selected)} шт.)", callback_data="do_export")
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def _markup_key(keyboard: InlineKeyboardMarkup) -> tuple:
+    """Неизменяемый снимок клавиатуры для сравнения (rows в кэше меняются на месте)"""
+    return tuple(tuple((b.text, b.callback_data) for b in row) for row in keyboard.inline_keyboard)
+
+
+async def update_chats_keyboard(user_id: int, message, keyboard: InlineKeyboardMarkup):
+    """Показать новую клавиатуру списка чатов (ошибки правки не критичны)
+
+    Сравниваем с последней клавиатурой, которую бот сам отправил в это сообщение,
+    а не с message.reply_markup из callback: при быстрых повторных нажатиях там
+    уже устаревшая разметка. Снимок ставится до запроса, чтобы параллельный
+    callback сравнивал с тем, что уйдёт в Telegram.
+    """
+    key = _markup_key(keyboard)
+    cached = user_keyboard_cache.get(user_id)
+    if cached and cached["message_id"] == message.message_id:
+        if cached.get("shown") == key:
+            return
+        cached["shown"] = key
+    try:
+        await safe_edit_reply_markup(message, reply_markup=keyboard)
+    except Exception:
+        # Неизвестно, что на экране — следующая правка пойдёт без сравнения
+        if cached and cached.get("shown") == key:
+            cached["shown"] = None
 
 
-@router.callback_query(F.data.startswith("page:"))
 async def handle_pagination(callback: CallbackQuery, state: FSMContext):
     """Переключение страниц"""
     # Отвечаем на callback сразу
@@ -661,45 +1276,43 @@ async def handle_pagination(callback: CallbackQuery, state: FSMContext):
     mode = parts[1]  # groups, private или hidden
     page = int(parts[2])
 
-    data = await state.get_data()
+    chat_lists = user_contacts_cache.get(callback.from_user.id, {})
     if mode == "groups":
-        chats = data.get("groups", [])
+        chats = chat_lists.get("groups", [])
     elif mode == "private":
-        chats = data.get("private", [])
+        chats = chat_lists.get("private", [])
     else:
-        chats = data.get("hidden", [])
+        chats = chat_lists.get("hidden", [])
 
-    selected = user_selected_chats.get(callback.from_user.id, [])
+    selected = user_selected_chats.get(callback.from_user.id, set())
     search_query = user_search_query.get(callback.from_user.id, "")
-    has_hidden = len(data.get("hidden", [])) > 0
+    has_hidden = len(chat_lists.get("hidden", [])) > 0
 
     await state.update_data(current_page=page, current_mode=mode)
 
-    keyboard = build_chats_keyboard(chats, selected, page=page, mode=mode, has_hidden=has_hidden, search_query=search_query)
-    try:
-        await callback.message.edit_reply_markup(reply_markup=keyboard)
-    except Exception:
-        pass
+    keyboard = build_chats_keyboard(chats, selected, page=page, mode=mode, has_hidden=has_hidden, search_query=search_query, user_id=callback.from_user.id)
+    remember_chats_keyboard(callback.from_user.id, callback.message.message_id, keyboard)
+    await update_chats_keyboard(callback.from_user.id, callback.message, keyboard)
 
 
-@router.callback_query(F.data == "show_private")
 async def show_private_chats(callback: CallbackQuery, state: FSMContext):
     """Показать личные чаты"""
     # Отвечаем на callback сразу
     await callback.answer()
 
-    data = await state.get_data()
-    private = data.get("private", [])
-    hidden = data.get("hidden", [])
-    selected = user_selected_chats.get(callback.from_user.id, [])
+    chat_lists = user_contacts_cache.get(callback.from_user.id, {})
+    private = chat_lists.get("private", [])
+    hidden = chat_lists.get("hidden", [])
+    selected = user_selected_chats.get(callback.from_user.id, set())
     search_query = user_search_query.get(callback.from_user.id, "")
 
     await state.update_data(current_page=0, current_mode="private")
 
-    keyboard = build_chats_keyboard(private, selected, page=0, mode="private", has_hidden=len(hidden) > 0, search_query=search_query)
+    keyboard = build_chats_keyboard(private, selected, page=0, mode="private", has_hidden=len(hidden) > 0, search_query=search_query, user_id=callback.from_user.id)
+    remember_chats_keyboard(callback.from_user.id, callback.message.message_id, keyboard, shown=True)
 
     # Считаем удалённых
-    deleted_count = len([c for c in private if c.get("is_blocked") or (c.get("name") == c.get("sn") and "@" in c.get("sn", "") and "@chat.agent" not in c.get("sn", ""))])
+    deleted_count = chat_lists.get("deleted_count", 0)
 
     hidden_text = f"\n🎂 Скрытых: {len(hidden)}" if hidden else ""
     search_text = f"\n🔍 Фильтр: «{search_query}»" if search_query else ""
@@ -717,22 +1330,22 @@ async def show_private_chats(callback: CallbackQuery, state: FSMContext):
         pass
 
 
-@router.callback_query(F.data == "show_groups")
 async def show_group_chats(callback: CallbackQuery, state: FSMContext):
     """Показать групповые чаты"""
     # Отвечаем на callback сразу
     await callback.answer()
 
-    data = await state.get_data()
-    groups = data.get("groups", [])
-    private = data.get("private", [])
-    hidden = data.get("hidden", [])
-    selected = user_selected_chats.get(callback.from_user.id, [])
+    chat_lists = user_contacts_cache.get(callback.from_user.id, {})
+    groups = chat_lists.get("groups", [])
+    private = chat_lists.get("private", [])
+    hidden = chat_lists.get("hidden", [])
+    selected = user_selected_chats.get(callback.from_user.id, set())
     search_query = user_search_query.get(callback.from_user.id, "")
 
     await state.update_data(current_page=0, current_mode="groups")
 
-    keyboard = build_chats_keyboard(groups, selected, page=0, mode="groups", has_hidden=len(hidden) > 0, search_query=search_query)
+    keyboard = build_chats_keyboard(groups, selected, page=0, mode="groups", has_hidden=len(hidden) > 0, search_query=search_query, user_id=callback.from_user.id)
+    remember_chats_keyboard(callback.from_user.id, callback.message.message_id, keyboard, shown=True)
 
     hidden_text = f"\n🎂 Скрытых: {len(hidden)}" if hidden else ""
     search_text = f"\n🔍 Фильтр: «{search_query}»" if search_query else ""
@@ -749,20 +1362,20 @@ async def show_group_chats(callback: CallbackQuery, state: FSMContext):
         pass
 
 
-@router.callback_query(F.data == "show_hidden")
 async def show_hidden_chats(callback: CallbackQuery, state: FSMContext):
     """Показать скрытые чаты (ДР, свадьба, поздравления)"""
     # Отвечаем на callback сразу
     await callback.answer()
 
-    data = await state.get_data()
-    hidden = data.get("hidden", [])
-    selected = user_selected_chats.get(callback.from_user.id, [])
+    chat_lists = user_contacts_cache.get(callback.from_user.id, {})
+    hidden = chat_lists.get("hidden", [])
+    selected = user_selected_chats.get(callback.from_user.id, set())
     search_query = user_search_query.get(callback.from_user.id, "")
 
     await state.update_data(current_page=0, current_mode="hidden")
 
-    keyboard = build_chats_keyboard(hidden, selected, page=0, mode="hidden", has_hidden=True, search_query=search_query)
+    keyboard = build_chats_keyboard(hidden, selected, page=0, mode="hidden", has_hidden=True, search_query=search_query, user_id=callback.from_user.id)
+    remember_chats_keyboard(callback.from_user.id, callback.message.message_id, keyboard, shown=True)
 
     search_text = f"\n🔍 Фильтр: «{search_query}»" if search_query else ""
 
@@ -778,13 +1391,11 @@ async def show_hidden_chats(callback: CallbackQuery, state: FSMContext):
         pass
 
 
-@router.callback_query(F.data == "noop")
 async def handle_noop(callback: CallbackQuery):
     """Пустое действие для кнопки с номером страницы"""
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("select:"))
 async def toggle_chat_selection(callback: CallbackQuery, state: FSMContext):
     """Выбор/отмена выбора чата"""
     # Отвечаем на callback сразу, чтобы не истек timeout
@@ -794,38 +1405,38 @@ async def toggle_chat_selection(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
 
     if user_id not in user_selected_chats:
-        user_selected_chats[user_id] = []
+        user_selected_chats[user_id] = set()
 
     selected = user_selected_chats[user_id]
 
     if sn in selected:
         selected.remove(sn)
     else:
-        selected.append(sn)
-
-    # Обновляем клавиатуру с новым состоянием чекбоксов
-    data = await state.get_data()
-    mode = data.get("current_mode", "groups")
-    page = data.get("current_page", 0)
-    search_query = user_search_query.get(user_id, "")
-    has_hidden = len(data.get("hidden", [])) > 0
-
-    if mode == "groups":
-        chats = data.get("groups", [])
-    elif mode == "private":
-        chats = data.get("private", [])
-    else:
-        chats = data.get("hidden", [])
+        selected.add(sn)
+
+    # Точечно меняем чекбокс в закэшированной клавиатуре, без полной перестройки
+    keyboard = toggle_cached_keyboard(user_id, callback.message.message_id, sn, selected)
+    if keyboard is None:
+        data = await state.get_data()
+        chat_lists = user_contacts_cache.get(user_id, {})
+        mode = data.get("current_mode", "groups")
+        page = data.get("current_page", 0)
+        search_query = user_search_query.get(user_id, "")
+        has_hidden = len(chat_lists.get("hidden", [])) > 0
+
+        if mode == "groups":
+            chats = chat_lists.get("groups", [])
+        elif mode == "private":
+            chats = chat_lists.get("private", [])
+        else:
+            chats = chat_lists.get("hidden", [])
 
-    keyboard = build_chats_keyboard(chats, selected, page=page, mode=mode, has_hidden=has_hidden, search_query=search_query)
+        keyboard = build_chats_keyboard(chats, selected, page=page, mode=mode, has_hidden=has_hidden, search_query=search_query, user_id=user_id)
+        remember_chats_keyboard(user_id, callback.message.message_id, keyboard)
 
-    try:
-        await callback.message.edit_reply_markup(reply_markup=keyboard)
-    except Exception:
-        pass
+    await update_chats_keyboard(callback.from_user.id, callback.message, keyboard)
 
 
-@router.callback_query(F.data.startswith("select_all:"))
 async def select_all_current(callback: CallbackQuery, state: FSMContext):
     """Выбрать все чаты текущего типа"""
     # Отвечаем на callback сразу
@@ -834,43 +1445,38 @@ async def select_all_current(callback: CallbackQuery, state: FSMContext):
     mode = callback.data.split(":")[1]
     data = await state.get_data()
     user_id = callback.from_user.id
+    chat_lists = user_contacts_cache.get(user_id, {})
 
     if mode == "groups":
-        chats = data.get("groups", [])
+        chats = chat_lists.get("groups", [])
     elif mode == "private":
-        chats = data.get("private", [])
+        chats = chat_lists.get("private", [])
     else:
-        chats = data.get("hidden", [])
+        chats = chat_lists.get("hidden", [])
 
     page = data.get("current_page", 0)
     search_query = user_search_query.get(user_id, "")
-    has_hidden = len(data.get("hidden", [])) > 0
-
-    # Фильтруем по поиску при добавлении
-    if search_query:
-        search_lower = search_query.lower()
-        chats_to_add = [c for c in chats if search_lower in (c.get("name", "") or c.get("sn", "")).lower()]
-    else:
-        chats_to_add = chats
+    has_hidden = len(chat_lists.get("hidden", [])) > 0
 
     # Добавляем к уже выбранным
     if user_id not in user_selected_chats:
-        user_selected_chats[user_id] = []
+        user_selected_chats[user_id] = set()
 
     selected = user_selected_chats[user_id]
-    for c in chats_to_add:
-        sn = c.get("sn")
-        if sn and sn not in selected:
-            selected.append(sn)
+    if not search_query and chat_lists.get(mode) is chats:
+        # Без поиска — готовый список sn категории, без обхода контактов
+        selected.update(chat_lists["sn_index"][mode])
+        selected.discard("")
+    else:
+        # Фильтруем по поиску при добавлении
+        chats_to_add = filter_chats(chats, search_query, user_id=user_id, mode=mode)
+        selected.update(c["_sn"] for c in chats_to_add if c["_sn"])
 
-    keyboard = build_chats_keyboard(chats, selected, page=page, mode=mode, has_hidden=has_hidden, search_query=search_query)
-    try:
-        await callback.message.edit_reply_markup(reply_markup=keyboard)
-    except Exception:
-        pass
+    keyboard = build_chats_keyboard(chats, selected, page=page, mode=mode, has_hidden=has_hidden, search_query=search_query, user_id=user_id)
+    remember_chats_keyboard(callback.from_user.id, callback.message.message_id, keyboard)
+    await update_chats_keyboard(callback.from_user.id, callback.message, keyboard)
 
 
-@router.callback_query(F.data == "clear_selection")
 async def clear_selection(callback: CallbackQuery, state: FSMContext):
     """Сбросить выбор"""
     # Отвечаем на callback сразу
@@ -878,28 +1484,26 @@ async def clear_selection(callback: CallbackQuery, state: FSMContext):
 
     data = await state.get_data()
     user_id = callback.from_user.id
+    chat_lists = user_contacts_cache.get(user_id, {})
     mode = data.get("current_mode", "groups")
     page = data.get("current_page", 0)
     search_query = user_search_query.get(user_id, "")
-    has_hidden = len(data.get("hidden", [])) > 0
+    has_hidden = len(chat_lists.get("hidden", [])) > 0
 
     if mode == "groups":
-        chats = data.get("groups", [])
+        chats = chat_lists.get("groups", [])
     elif mode == "private":
-        chats = data.get("private", [])
+        chats = chat_lists.get("private", [])
     else:
-        chats = data.get("hidden", [])
+        chats = chat_lists.get("hidden", [])
 
-    user_selected_chats[user_id] = []
+    user_selected_chats[user_id] = set()
 
-    keyboard = build_chats_keyboard(chats, [], page=page, mode=mode, has_hidden=has_hidden, search_query=search_query)
-    try:
-        await callback.message.edit_reply_markup(reply_markup=keyboard)
-    except Exception:
-        pass
+    keyboard = build_chats_keyboard(chats, set(), page=page, mode=mode, has_hidden=has_hidden, search_query=search_query, user_id=user_id)
+    remember_chats_keyboard(callback.from_user.id, callback.message.message_id, keyboard)
+    await update_chats_keyboard(callback.from_user.id, callback.message, keyboard)
 
 
-@router.callback_query(F.data == "start_search")
 async def start_search(callback: CallbackQuery, state: FSMContext):
     """Начать поиск по чатам"""
     await callback.answer()
@@ -916,7 +1520,6 @@ async def start_search(callback: CallbackQuery, state: FSMContext):
     )
 
 
-@router.callback_query(F.data == "cancel_search")
 async def cancel_search(callback: CallbackQuery, state: FSMContext):
     """Отменить поиск"""
     await callback.answer()
@@ -927,7 +1530,6 @@ async def cancel_search(callback: CallbackQuery, state: FSMContext):
         pass
 
 
-@router.callback_query(F.data == "clear_search")
 async def clear_search(callback: CallbackQuery, state: FSMContext):
     """Сбросить поисковый фильтр"""
     # Отвечаем на callback сразу
@@ -936,25 +1538,23 @@ async def clear_search(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     user_search_query[user_id] = ""
 
-    data = await state.get_data()
+    # update_data возвращает актуальные данные — один запрос к хранилищу FSM вместо двух
+    data = await state.update_data(current_page=0)
+    chat_lists = user_contacts_cache.get(callback.from_user.id, {})
     mode = data.get("current_mode", "groups")
-    selected = user_selected_chats.get(user_id, [])
-    has_hidden = len(data.get("hidden", [])) > 0
+    selected = user_selected_chats.get(user_id, set())
+    has_hidden = len(chat_lists.get("hidden", [])) > 0
 
     if mode == "groups":
-        chats = data.get("groups", [])
+        chats = chat_lists.get("groups", [])
     elif mode == "private":
-        chats = data.get("private", [])
+        chats = chat_lists.get("private", [])
     else:
-        chats = data.get("hidden", [])
-
-    await state.update_data(current_page=0)
+        chats = chat_lists.get("hidden", [])
 
     keyboard = build_chats_keyboard(chats, selected, page=0, mode=mode, has_hidden=has_hidden, search_query="")
-    try:
-        await callback.message.edit_reply_markup(reply_markup=keyboard)
-    except Exception:
-        pass
+    remember_chats_keyboard(callback.from_user.id, callback.message.message_id, keyboard)
+    await update_chats_keyboard(callback.from_user.id, callback.message, keyboard)
 
 
 @router.message(ExportStates.searching)
@@ -974,30 +1574,28 @@ async def process_search_query(message: Message, state: FSMContext):
     user_search_query[user_id] = search_query
     await state.set_state(ExportStates.selecting_chats)
 
-    data = await state.get_data()
+    data = await state.update_data(current_page=0)
+    chat_lists = user_contacts_cache.get(user_id, {})
     mode = data.get("current_mode", "groups")
-    selected = user_selected_chats.get(user_id, [])
-    has_hidden = len(data.get("hidden", [])) > 0
+    selected = user_selected_chats.get(user_id, set())
+    has_hidden = len(chat_lists.get("hidden", [])) > 0
 
     if mode == "groups":
-        chats = data.get("groups", [])
+        chats = chat_lists.get("groups", [])
         title = "👥 Групповые чаты"
     elif mode == "private":
-        chats = data.get("private", [])
+        chats = chat_lists.get("private", [])
         title = "👤 Личные чаты"
     else:
-        chats = data.get("hidden", [])
+        chats = chat_lists.get("hidden", [])
         title = "🎂 Скрытые чаты"
 
     # Считаем отфильтрованные
-    search_lower = search_query.lower()
-    filtered_count = len([c for c in chats if search_lower in (c.get("name", "") or c.get("sn", "")).lower()])
-
-    await state.update_data(current_page=0)
+    filtered_count = len(filter_chats(chats, search_query, user_id=user_id, mode=mode))
 
-    keyboard = build_chats_keyboard(chats, selected, page=0, mode=mode, has_hidden=has_hidden, search_query=search_query)
+    keyboard = build_chats_keyboard(chats, selected, page=0, mode=mode, has_hidden=has_hidden, search_query=search_query, user_id=user_id)
 
-    await message.answer(
+    list_msg = await message.answer(
         f"{title}\n"
         f"🔍 Найдено: {filtered_count} из {len(chats)}\n"
         f"Фильтр: «{search_query}»\n\n"
@@ -1005,14 +1603,14 @@ async def process_search_query(message: Message, state: FSMContext):
         reply_markup=keyboard,
         parse_mode="HTML"
     )
+    remember_chats_keyboard(user_id, list_msg.message_id, keyboard, shown=True)
 
 
-@router.callback_query(F.data == "do_export")
 async def do_export(callback: CallbackQuery, state: FSMContext):
     """Начать экспорт выбранных чатов"""
     user_id = callback.from_user.id
     session = user_sessions.get(user_id)
-    selected = user_selected_chats.get(user_id, [])
+    selected = user_selected_chats.get(user_id, set())
 
     if not session:
         await callback.answer("❌ Сессия истекла, авторизуйтесь заново: /auth", show_alert=True)
@@ -1046,7 +1644,6 @@ async def do_export(callback: CallbackQuery, state: FSMContext):
     )
 
 
-@router.callback_query(F.data.startswith("avatars:"))
 async def ask_export_format(callback: CallbackQuery, state: FSMContext):
     """Спросить формат экспорта после выбора аватарок"""
     # Отвечаем на callback сразу
@@ -1054,7 +1651,7 @@ async def ask_export_format(callback: CallbackQuery, state: FSMContext):
 
     avatars_choice = callback.data.split(":")[1]  # yes или no
     user_id = callback.from_user.id
-    selected = user_selected_chats.get(user_id, [])
+    selected = user_selected_chats.get(user_id, set())
 
     # Сохраняем выбор в state
     await state.update_data(with_avatars=(avatars_choice == "yes"))
@@ -1078,7 +1675,6 @@ async def ask_export_format(callback: CallbackQuery, state: FSMContext):
     )
 
 
-@router.callback_query(F.data.startswith("format:"))
 async def process_export(callback: CallbackQuery, state: FSMContext):
     """Выбор формата: JSON → сразу экспорт, HTML/both → вопрос про файлы"""
     format_type = callback.data.split(":")[1]
@@ -1100,19 +1696,18 @@ async def process_export(callback: CallbackQuery, state: FSMContext):
         )
         return
 
-    await state.update_data(format_type=format_type)
-
     if format_type == "json":
         # JSON — файлов нет, экспорт сразу
-        await state.update_data(with_files=False)
-        await do_actual_export(callback, state)
+        state_data = await state.update_data(format_type=format_type, with_files=False)
+        await do_actual_export(callback, state, state_data)
     elif format_type == "files_only":
         # Только файлы — проверяем блокировку, нет вопросов про HTML
         active = user_active_exports.get(user_id)
         if active and os.path.isdir(active["path"]):
-            remaining_sec = 600 - (datetime.now().timestamp() - active["created_at"])
+            remaining_sec = EXPORTS_TTL - (time.monotonic() - active["created_monotonic"])
             if remaining_sec > 0:
                 remaining_min = max(1, round(remaining_sec / 60))
+                await state.update_data(format_type=format_type)
                 builder = InlineKeyboardBuilder()
                 builder.button(text="🗑️ Удалить и продолжить", callback_data="files:delete")
                 builder.adjust(1)
@@ -1127,27 +1722,29 @@ async def process_export(callback: CallbackQuery, state: FSMContext):
                 )
                 return
         user_active_exports.pop(user_id, None)
-        await state.update_data(with_files=True)
-        await do_actual_export(callback, state)
+        state_data = await state.update_data(format_type=format_type, with_files=True)
+        await do_actual_export(callback, state, state_data)
     else:
         # HTML или both — спрашиваем про файлы
-        await _show_files_question(callback, state)
+        await _show_files_question(callback, state, format_type)
 
 
-async def _show_files_question(callback, state):
+async def _show_files_question(callback, state, format_type: str):
     """Вопрос про файлы, или предупреждение об активной выгрузке"""
     user_id = callback.from_user.id
 
     # Файлы глобально отключены — не спрашиваем, идём без файлов
     if not _files_enabled:
-        await state.update_data(with_files=False)
-        await do_actual_export(callback, state)
+        state_data = await state.update_data(format_type=format_type, with_files=False)
+        await do_actual_export(callback, state, state_data)
         return
 
+    await state.update_data(format_type=format_type)
+
     # Проверяем, есть ли ещё активная выгрузка файлов
     active = user_active_exports.get(user_id)
     if active and os.path.isdir(active["path"]):
-        remaining_sec = 600 - (datetime.now().timestamp() - active["created_at"])
+        remaining_sec = EXPORTS_TTL - (time.monotonic() - active["created_monotonic"])
         if remaining_sec > 0:
             remaining_min = max(1, round(remaining_sec / 60))
             builder = InlineKeyboardBuilder()
@@ -1187,7 +1784,6 @@ async def _show_files_question(callback, state):
     )
 
 
-@router.callback_query(F.data.startswith("files:"))
 async def handle_files_choice(callback: CallbackQuery, state: FSMContext):
     """Обработка: с файлами / без / удалить старые и продолжить"""
     choice = callback.data.split(":")[1]  # yes, no, delete
@@ -1196,23 +1792,21 @@ async def handle_files_choice(callback: CallbackQuery, state: FSMContext):
 
     if choice in ("yes", "delete") and not _files_enabled:
         # Файлы глобально отключены — старая кнопка, идём без файлов
-        await state.update_data(with_files=False)
+        with_files = False
     elif choice == "delete":
         # Удаляем старую выгрузку и идём с файлами
         active = user_active_exports.pop(user_id, None)
         if active:
-            shutil.rmtree(active["path"], ignore_errors=True)
-            print(f"📎 User {user_id} deleted active export {active['uuid']}")
-        await state.update_data(with_files=True)
-    elif choice == "yes":
-        await state.update_data(with_files=True)
-    else:  # no
-        await state.update_data(with_files=False)
+            await remove_export_dir(active["path"])
+            logger.info("User %s deleted active export %s", user_id, active["uuid"])
+        with_files = True
+    else:
+        with_files = choice == "yes"
 
-    await do_actual_export(callback, state)
+    state_data = await state.update_data(with_files=with_files)
+    await do_actual_export(callback, state, state_data)
 
 
-@router.callback_query(F.data.startswith("delete_files:"))
 async def handle_delete_files(callback: CallbackQuery):
     """Кнопка «Удалить файлы» в сообщении о завершении"""
     user_id = callback.from_user.id
@@ -1221,20 +1815,24 @@ async def handle_delete_files(callback: CallbackQuery):
     if active and active["uuid"] == req_uuid:
         # Отвечаем сразу, до удаления файлов
         await callback.answer()
-        shutil.rmtree(active["path"], ignore_errors=True)
+        await remove_export_dir(active["path"])
         user_active_exports.pop(user_id, None)
         await safe_edit_reply_markup(callback.message, reply_markup=None)
     else:
         await callback.answer("Файлы уже удалены", show_alert=True)
 
 
-async def do_actual_export(callback: CallbackQuery, state: FSMContext):
-    """Выполнить экспорт в выбранном формате"""
+async def do_actual_export(callback: CallbackQuery, state: FSMContext, state_data: dict = None):
+    """Выполнить экспорт в выбранном формате
+
+    state_data — данные FSM, уже полученные вызывающим хендлером (без повторного get_data)
+    """
     user_id = callback.from_user.id
-    session = user_sessions.get(user_id)
-    selected = user_selected_chats.get(user_id, [])
+    # Множество → список в стабильном порядке для экспорта
+    selected = sorted(user_selected_chats.get(user_id, ()))
 
-    state_data = await state.get_data()
+    if state_data is None:
+        state_data = await state.get_data()
     format_type = state_data.get("format_type", "html")
     with_files = state_data.get("with_files", False)
 
@@ -1243,94 +1841,128 @@ async def do_actual_export(callback: CallbackQuery, state: FSMContext):
 
     # Устанавливаем блокировку
     user_exporting[user_id] = True
+    # Экспорт идёт минуты: отпускаем очередь апдейтов пользователя, чтобы его
+    # остальные нажатия («экспорт уже идёт», удалить файлы) не ждали конца;
+    # повторный экспорт не даст начать user_exporting
+    lock = user_lock(user_id)
+    released = lock.locked()
+    if released:
+        lock.release()
+    status = None
+    try:
+        total = len(selected)
+        status_msg = await callback.message.edit_text(
+            f"⏳ <b>Экспорт чатов</b>\n\n"
+            f"{make_progress_bar(0, total)}\n\n"
+            f"Подготовка...",
+            parse_mode="HTML"
+        )
+        # Все последующие правки статуса — через одного писателя с троттлингом
+        status = StatusWriter(status_msg)
+
+        client = get_client(user_id)
+        all_exports = []
+        errors = []
+        no_dialogs = []  # Контакты без диалога (не ошибка)
+        no_access = []   # Чаты без доступа (Permission denied)
+        critical_error = None
+        avatars = {}  # Словарь аватарок (собираем по ходу экспорта)
+
+        # Получаем данные о чатах заранее
+        all_chats = user_contacts_cache.get(user_id, {}).get("contacts", [])
+        chats_by_sn = {c.get("sn"): c for c in all_chats if c.get("sn")}  # Индекс sn → контакт
+        with_avatars = state_data.get("with_avatars", True)
+
+        # Сигнал прогресса аватарок: ставится после каждой обработанной аватарки
+        avatar_progress = asyncio.Event()
+
+        # Общий лимит частоты запросов аватарок на все воркеры этой выгрузки
+        avatar_limiter = AsyncLimiter(config.AVATAR_RATE_PER_SEC, 1)
+
+        # Фоновые воркеры загрузки аватарок (только для HTML и если пользователь выбрал)
+        async def avatar_downloader(queue, avatars_dict):
+            """Воркер загрузки аватарок: берёт sn из общей очереди, частота — через avatar_limiter"""
+            while True:
+                chat_sn = await queue.get()
+                if chat_sn is None:  # Сигнал завершения (по одному на воркер)
+                    queue.task_done()
+                    avatar_progress.set()
+                    break
+
+                if chat_sn not in avatars_dict:
+                    try:
+                        async with avatar_limiter:
+                            avatar_data = await client.get_avatar(chat_sn, size="small")
+                        if avatar_data:
+                            avatars_dict[chat_sn] = avatar_data
+                            if len(avatars_dict) % 10 == 0:
+                                logger.debug("Background: downloaded %d avatars", len(avatars_dict))
+                    except Exception as e:
+                        pass  # Аватарки не критичны
 
-    total = len(selected)
-    status_msg = await callback.message.edit_text(
-        f"⏳ <b>Экспорт чатов</b>\n\n"
-        f"{make_progress_bar(0, total)}\n\n"
-        f"Подготовка...",
-        parse_mode="HTML"
-    )
+                    avatar_progress.set()
 
-    client = VKTeamsClient(session)
-    all_exports = []
-    errors = []
-    no_dialogs = []  # Контакты без диалога (не ошибка)
-    no_access = []   # Чаты без доступа (Permission denied)
-    critical_error = None
-    avatars = {}  # Словарь аватарок (собираем по ходу экспорта)
-
-    # Получаем данные о чатах заранее
-    all_chats = state_data.get("contacts", [])
-    with_avatars = state_data.get("with_avatars", True)
-
-    # Фоновая задача для загрузки аватарок (только для HTML и если пользователь выбрал)
-    async def avatar_downloader(queue, avatars_dict):
-        """Асинхронная загрузка аватарок с умным rate limiting"""
-        downloaded = 0
-        while True:
-            chat_sn = await queue.get()
-            if chat_sn is None:  # Сигнал завершения
                 queue.task_done()
-                break
 
-            if chat_sn not in avatars_dict:
+        avatar_queue = asyncio.Queue()
+        avatar_task = None
+        if format_type in ("html", "both") and with_avatars:
+            avatar_workers = [
+                asyncio.create_task(avatar_downloader(avatar_queue, avatars))
+                for _ in range(config.AVATAR_WORKERS)
+            ]
+            # Одна задача-агрегат: «готово», когда завершились все воркеры
+            avatar_task = asyncio.gather(*avatar_workers)
+            logger.info("Started %d background avatar downloaders", len(avatar_workers))
+
+        # Чаты экспортируются параллельно (ограничено семафором), паузы между страницами — внутри клиента
+        export_sem = asyncio.Semaphore(config.EXPORT_CONCURRENCY)
+
+        async def _export_one(sn):
+            """Экспорт одного чата: (sn, export_data | None, ошибка | None)"""
+            async with export_sem:
                 try:
-                    avatar_data = await client.get_avatar(chat_sn, size="small")
-                    if avatar_data:
-                        avatars_dict[chat_sn] = avatar_data
-                        downloaded += 1
-                        if downloaded % 10 == 0:
-                            print(f"📷 Background: downloaded {downloaded} avatars (total: {len(avatars_dict)})")
+                    return sn, await client.export_chat(sn), None
                 except Exception as e:
-                    pass  # Аватарки не критичны
-
-                # Пауза для избежания rate limit
-                await asyncio.sleep(0.8)
+                    return sn, None, e
 
-            queue.task_done()
-
-    avatar_queue = asyncio.Queue()
-    avatar_task = None
-    if format_type in ("html", "both") and with_avatars:
-        avatar_task = asyncio.create_task(avatar_downloader(avatar_queue, avatars))
-        print("📷 Started background avatar downloader")
+        exported = {}  # {sn: export_data}
+        total_msgs = 0  # Общее количество сообщений — считается по ходу экспорта
+        chat_folders = {}  # {sn: имя папки для файлов чата} — вычисляется один раз при экспорте
+        export_tasks = [asyncio.create_task(_export_one(sn)) for sn in selected]
+        try:
+            for i, next_done in enumerate(asyncio.as_completed(export_tasks)):
+                sn, export_data, export_err = await next_done
 
-    try:
-        for i, sn in enumerate(selected):
-            try:
-                # Обновляем статус перед каждым чатом
-                chat_info = next((c for c in all_chats if c.get("sn") == sn), {})
+                chat_info = chats_by_sn.get(sn, {})
                 chat_name = chat_info.get("name") or chat_info.get("friendly") or sn
+                # Папка файлов чата (вне export_data, чтобы не попала в JSON/HTML) — только если качаем файлы
+                if with_files:
+                    chat_folders[sn] = (chat_name or "unknown").translate(_SANITIZE).strip()[:60] or "unknown"
                 chat_name = chat_name[:35] + "..." if len(chat_name) > 35 else chat_name
 
                 # Show blocked indicator
                 if chat_info.get("is_blocked"):
                     chat_name = f"🚫 {chat_name}"
 
-                # Обновляем статус только каждые 5 чатов или на последнем
-                if (i + 1) % 5 == 0 or i == total - 1:
-                    await safe_edit_text(
-                        status_msg,
-                        f"⏳ <b>Экспорт чатов</b>\n\n"
-                        f"{make_progress_bar(i + 1, total)}\n\n"
-                        f"📥 {chat_name}",
-                        parse_mode="HTML"
-                    )
-
-                # Экспортируем чат
-                export_data = await client.export_chat(sn)
-                all_exports.append(export_data)
+                # Писатель статуса сам прореживает правки — ставим каждое состояние
+                status.update(
+                    f"⏳ <b>Экспорт чатов</b>\n\n"
+                    f"{make_progress_bar(i + 1, total)}\n\n"
+                    f"📥 {chat_name}",
+                    parse_mode="HTML"
+                )
 
-                # Добавляем аватарку в очередь на фоновую загрузку
-                if avatar_task and export_data.get("chat_sn"):
-                    await avatar_queue.put(export_data["chat_sn"])
+                if export_err is None:
+                    exported[sn] = export_data
+                    total_msgs += export_data.get('total_messages', 0)
 
-                # Небольшая пауза между чатами
-                await asyncio.sleep(0.3)
+                    # Добавляем аватарку в очередь на фоновую загрузку
+                    if avatar_task and export_data.get("chat_sn"):
+                        await avatar_queue.put(export_data["chat_sn"])
+                    continue
 
-            except Exception as e:
-                err_str = str(e)
+                err_str = str(export_err)
                 if "No such dialogue" in err_str:
                     # Это не ошибка - просто нет диалога с контактом
                     no_dialogs.append(sn)
@@ -1342,434 +1974,492 @@ async def do_actual_export(callback: CallbackQuery, state: FSMContext):
                 else:
                     errors.append(f"{sn}: {err_str}")
 
-    except Exception as e:
-        critical_error = str(e)
-
-    # Завершаем фоновую загрузку аватарок
-    if avatar_task:
-        # Отправляем сигнал завершения
-        await avatar_queue.put(None)
-        # Ждём завершения загрузки (максимум 60 секунд) с отображением прогресса
-        print(f"📷 Waiting for background avatar download to complete...")
-        total_avatars_to_download = len(all_exports)
-        loop = asyncio.get_running_loop()
-        start_wait = loop.time()
-
-        while not avatar_task.done() and (loop.time() - start_wait) < 60:
-            current_downloaded = len(avatars)
-            await safe_edit_text(
-                status_msg,
-                f"📷 <b>Загрузка аватарок</b>\n\n"
-                f"{make_progress_bar(current_downloaded, total_avatars_to_download)}\n\n"
-                f"Загружено: {current_downloaded} из {total_avatars_to_download}",
-                parse_mode="HTML"
-            )
-            await asyncio.sleep(10.0)
-
-        if avatar_task.done():
-            print(f"📷 Background download complete: {len(avatars)} avatars total")
-        else:
-            avatar_task.cancel()
-            print(f"📷 Avatar download timeout (got {len(avatars)} avatars)")
-
-    # Считаем общее количество сообщений
-    total_msgs = sum(e.get('total_messages', 0) for e in all_exports)
-
-    # Скачиваем файлы из переписок (только для HTML)
-    EXPORTS_DIR = "/tmp/vkteams_exports"
-    export_uuid = None
-    files_url_map = {}  # {original_url: local_url}
-    files_zip_url = ""
-    files_zip_size_mb = 0.0
-
-    # Очистка старых экспортов (>10 мин) перед новой загрузкой
-    if os.path.exists(EXPORTS_DIR):
-        now_ts = datetime.now().timestamp()
-        for entry in os.listdir(EXPORTS_DIR):
-            entry_path = os.path.join(EXPORTS_DIR, entry)
-            if os.path.isdir(entry_path) and now_ts - os.path.getmtime(entry_path) > 600:
-                shutil.rmtree(entry_path, ignore_errors=True)
-                print(f"📎 Cleaned up old export: {entry}")
-
-    if format_type in ("html", "both", "files_only") and all_exports and with_files:
-        # Собираем уникальные файлы, дедупликация по имени внутри каждого чата
-        all_files = {}  # {original_url: {name, size, mime, chat_folder}}
-        seen_keys = set()  # (chat_folder, name)
-        name_to_url = {}       # {name: первый original_url} — для подстановки дублей в HTML
-        duplicate_url_map = {} # {dup_url: first_url} — дубли по имени
-        for chat_export in all_exports:
-            # Определяем имя папки для файлов этого чата
-            chat_sn = chat_export.get("chat_sn", "")
-            chat_info_entry = next((c for c in all_chats if c.get("sn") == chat_sn), {})
-            raw_chat_name = chat_info_entry.get("name") or chat_info_entry.get("friendly") or chat_sn or "unknown"
-            chat_folder = raw_chat_name
-            for ch in '/\\:*?"<>|':
-                chat_folder = chat_folder.replace(ch, "_")
-            chat_folder = chat_folder.strip()[:60] or "unknown"
-
-            for msg in chat_export.get("messages", []):
-                for file in msg.get("filesharing", []):
-                    url = file.get("original_url")
-                    name = file.get("name", "")
-                    if not url:
-                        continue
-                    if url in all_files:
-                        continue
-                    dedup_key = (chat_folder, name)
-                    if name and dedup_key in seen_keys:
-                        # Дубль по имени в том же чате — не скачаем, но подставим ссылку первого
-                        duplicate_url_map[url] = name_to_url.get(name, url)
-                        continue
-                    all_files[url] = {
-                        "name": name or "file",
-                        "size": int(file.get("size", 0) or 0),
-                        "mime": file.get("mime", ""),
-                        "chat_folder": chat_folder,
-                    }
-                    if name:
-                        seen_keys.add(dedup_key)
-                        name_to_url[name] = url
-
-        if all_files:
-            # Оценочный размер
-            estimated_bytes = sum(f["size"] for f in all_files.values())
-            estimated_mb = estimated_bytes / 1024 ** 2
-
-            # Проверяем лимит диска для экспортов
-            exports_used_gb = sum(
-                os.path.getsize(os.path.join(dp, f)) / 1024**3
-                for dp, _, fns in os.walk(EXPORTS_DIR) for f in fns
-            ) if os.path.isdir(EXPORTS_DIR) else 0.0
-
-            if exports_used_gb >= config.MAX_DISK_GB:
-                print(f"⚠️ Exports disk limit reached ({exports_used_gb:.1f} / {config.MAX_DISK_GB} GB), skipping file downloads")
-                if _files_enabled:
-                    asyncio.ensure_future(_auto_disable_files())
-                await safe_edit_text(
-                    status_msg,
-                    f"⚠️ <b>Лимит диска для файлов достигнут</b>\n\n"
-                    f"Занято: <code>{exports_used_gb:.1f} / {config.MAX_DISK_GB} GB</code>\n"
-                    f"Файлы временно отключены — включат автоматически через 20 минут.\n\n"
-                    f"Экспорт продолжается без файлов.",
-                    parse_mode="HTML"
-                )
-            else:
-                export_uuid = str(uuid_mod.uuid4())
-                export_dir = os.path.join(EXPORTS_DIR, export_uuid)
-                os.makedirs(export_dir, exist_ok=True)
-
-                total_files = len(all_files)
-                downloaded_files = 0
-                total_bytes = 0
-                MAX_EXPORT_SIZE = config.MAX_EXPORT_GB * 1024 ** 3
-
-                max_export_mb = config.MAX_EXPORT_GB * 1024
-                size_warn = ""
-                if estimated_mb > max_export_mb:
-                    size_warn = f"\n⚠️ Оценка {estimated_mb:.0f} МБ > {config.MAX_EXPORT_GB} ГБ — загрузим первые {config.MAX_EXPORT_GB} ГБ"
-                dups_info = f" (пропущено {len(duplicate_url_map)} дублей)" if duplicate_url_map else ""
+        except Exception as e:
+            critical_error = str(e)
+            for task in export_tasks:
+                task.cancel()
+        except asyncio.CancelledError:
+            # Отменили сам экспорт — останавливаем и выгрузку чатов
+            for task in export_tasks:
+                task.cancel()
+            raise
 
-                await safe_edit_text(
-                    status_msg,
-                    f"📎 <b>Загрузка файлов</b>\n\n"
-                    f"{make_progress_bar(0, total_files)}\n\n"
-                    f"Файлов: {total_files}{dups_info}, ~{estimated_mb:.0f} МБ{size_warn}",
-                    parse_mode="HTML"
-                )
+        # Порядок чатов в экспорте — как в выборе
+        all_exports.extend(exported[sn] for sn in selected if sn in exported)
+
+        # Завершаем фоновую загрузку аватарок
+        if avatar_task:
+            # Отправляем сигнал завершения каждому воркеру
+            for _ in avatar_workers:
+                avatar_queue.put_nowait(None)
+            # Ждём завершения загрузки (максимум 60 секунд) с отображением прогресса
+            logger.info("Waiting for background avatar download to complete")
+            total_avatars_to_download = len(all_exports)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + 60
+
+            # Обновляем статус по событиям загрузчика и только при заметном приросте (~5%)
+            progress_step = max(1, total_avatars_to_download // 20)
+            last_shown = -progress_step
+            while not avatar_task.done():
+                current_downloaded = len(avatars)
+                if current_downloaded - last_shown >= progress_step:
+                    status.update(
+                        f"📷 <b>Загрузка аватарок</b>\n\n"
+                        f"{make_progress_bar(current_downloaded, total_avatars_to_download)}\n\n"
+                        f"Загружено: {current_downloaded} из {total_avatars_to_download}",
+                        parse_mode="HTML"
+                    )
+                    last_shown = current_downloaded
+                avatar_progress.clear()
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(avatar_progress.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
 
-                # Пре-вычисляем безопасные имена (без гонок при параллельной загрузке)
-                file_list = []  # [(orig_url, rel_path, dest_path)]
-                used_rel_paths = set()
-                for i, (orig_url, file_info) in enumerate(all_files.items()):
-                    safe_name = file_info["name"]
-                    for ch in '/\\:*?"<>|':
-                        safe_name = safe_name.replace(ch, "_")
-                    if not safe_name:
-                        safe_name = f"file_{i}"
-                    chat_folder = file_info["chat_folder"]
-                    rel_path = f"{chat_folder}/{safe_name}"
-                    if rel_path in used_rel_paths:
-                        base, ext = os.path.splitext(safe_name)
-                        safe_name = f"{base}_{i}{ext}"
-                        rel_path = f"{chat_folder}/{safe_name}"
-                    used_rel_paths.add(rel_path)
-                    chat_dir = os.path.join(export_dir, chat_folder)
-                    os.makedirs(chat_dir, exist_ok=True)
-                    file_list.append((orig_url, rel_path, os.path.join(chat_dir, safe_name)))
-
-                # Параллельная загрузка: 5 горутин одновременно
-                dl_sem = asyncio.Semaphore(5)
-
-                async def _download_one(orig_url, safe_name, dest_path):
-                    nonlocal downloaded_files, total_bytes
-                    async with dl_sem:
-                        if total_bytes >= MAX_EXPORT_SIZE:
-                            return
-                        try:
-                            file_id = orig_url.rstrip("/").split("/")[-1]
-                            dlink = await client.get_file_dlink(file_id)
-                            if not dlink:
-                                print(f"📎 No dlink for {safe_name} (file_id={file_id})")
-                                return
-                            data = await client.download_file(dlink, max_size=500 * 1024 * 1024)
-                            if data:
-                                with open(dest_path, "wb") as f:
-                                    f.write(data)
-                                downloaded_files += 1
-                                total_bytes += len(data)
-                                files_url_map[orig_url] = f"{config.PUBLIC_URL}/files/{export_uuid}/{safe_name}"
-                        except Exception as e:
-                            print(f"📎 Error downloading {safe_name}: {e}")
-
-                tasks = [asyncio.create_task(_download_one(url, name, path)) for url, name, path in file_list]
-                completed = 0
-                for coro in asyncio.as_completed(tasks):
-                    await coro
-                    completed += 1
-                    if completed % 50 == 0 or completed == total_files:
-                        await safe_edit_text(
-                            status_msg,
+            if avatar_task.done():
+                logger.info("Background avatar download complete: %d avatars", len(avatars))
+            else:
+                avatar_task.cancel()
+                logger.warning("Avatar download timeout (got %d avatars)", len(avatars))
+
+        # Скачиваем файлы из переписок (только для HTML)
+        export_uuid = None
+        files_url_map = {}  # {original_url: local_url}
+        files_zip_url = ""
+        files_zip_size_mb = 0.0
+
+        if format_type in ("html", "both", "files_only") and all_exports and with_files:
+            # Собираем уникальные файлы, дедупликация по имени внутри каждого чата
+            files_out: list[tuple[str, dict]] = []  # [(original_url, {name, size, mime, chat_folder})]
+            seen_urls: set[str] = set()
+            seen_keys: dict[tuple, str] = {}  # {(chat_folder, name): первый original_url} — для подстановки дублей в HTML
+            duplicate_url_map = {} # {dup_url: first_url} — дубли по имени
+            for chat_export in all_exports:
+                chat_folder = chat_folders.get(chat_export.get("chat_sn", ""), "unknown")
+
+                for msg in chat_export.get("messages", []):
+                    for file in msg.get("filesharing", []):
+                        url = file.get("original_url")
+                        if not url or url in seen_urls:
+                            continue
+                        seen_urls.add(url)
+                        name = file.get("name", "")
+                        if name:
+                            dedup_key = (chat_folder, name)
+                            first_url = seen_keys.get(dedup_key)
+                            if first_url is not None:
+                                # Дубль по имени в том же чате — не скачаем, но подставим ссылку первого
+                                duplicate_url_map[url] = first_url
+                                continue
+                            seen_keys[dedup_key] = url
+                        files_out.append((url, {
+                            "name": name or "file",
+                            "size": int(file.get("size") or 0),
+                            "mime": file.get("mime", ""),
+                            "chat_folder": chat_folder,
+                        }))
+
+            if files_out:
+                # Оценочный размер
+                estimated_bytes = sum(f["size"] for _, f in files_out)
+                estimated_mb = estimated_bytes / 1024 ** 2
+
+                # Проверяем лимит диска для экспортов
+                exports_used_gb = exports_used_bytes() / 1024**3
+
+                if exports_used_gb >= config.MAX_DISK_GB:
+                    logger.warning("Exports disk limit reached (%.1f / %s GB), skipping file downloads", exports_used_gb, config.MAX_DISK_GB)
+                    if _files_enabled:
+                        asyncio.ensure_future(_auto_disable_files())
+                    status.update(
+                        f"⚠️ <b>Лимит диска для файлов достигнут</b>\n\n"
+                        f"Занято: <code>{exports_used_gb:.1f} / {config.MAX_DISK_GB} GB</code>\n"
+                        f"Файлы временно отключены — включат автоматически через 20 минут.\n\n"
+                        f"Экспорт продолжается без файлов.",
+                        parse_mode="HTML"
+                    )
+                else:
+                    export_uuid = str(uuid_mod.uuid4())
+                    export_dir = os.path.join(EXPORTS_DIR, export_uuid)
+                    _export_sizes[export_dir] = 0
+                    _exports_writing.add(export_dir)
+                    try:
+                        total_files = len(files_out)
+                        downloaded_files = 0
+                        total_bytes = 0
+                        MAX_EXPORT_SIZE = config.MAX_EXPORT_GB * 1024 ** 3
+
+                        max_export_mb = config.MAX_EXPORT_GB * 1024
+                        size_warn = ""
+                        if estimated_mb > max_export_mb:
+                            size_warn = f"\n⚠️ Оценка {estimated_mb:.0f} МБ > {config.MAX_EXPORT_GB} ГБ — загрузим первые {config.MAX_EXPORT_GB} ГБ"
+                        dups_info = f" (пропущено {len(duplicate_url_map)} дублей)" if duplicate_url_map else ""
+
+                        status.update(
                             f"📎 <b>Загрузка файлов</b>\n\n"
-                            f"{make_progress_bar(completed, total_files)}\n\n"
-                            f"Загружено: {downloaded_files}/{total_files} ({total_bytes / 1024**2:.1f} MB)",
+                            f"{make_progress_bar(0, total_files)}\n\n"
+                            f"Файлов: {total_files}{dups_info}, ~{estimated_mb:.0f} МБ{size_warn}",
                             parse_mode="HTML"
                         )
 
-                print(f"📎 Files downloaded: {downloaded_files}/{total_files}, {total_bytes / 1024**2:.1f} MB total")
+                        # Пре-вычисляем безопасные имена (без гонок при параллельной загрузке)
+                        file_list = []  # [(orig_url, rel_path, dest_path)]
+                        used_rel_paths = set()
+                        chat_dirs: dict[str, str] = {}  # {chat_folder: путь} — папку создаём один раз на чат
+                        for i, (orig_url, file_info) in enumerate(files_out):
+                            safe_name = file_info["name"].translate(_SANITIZE)
+                            if not safe_name:
+                                safe_name = f"file_{i}"
+                            chat_folder = file_info["chat_folder"]
+                            rel_path = f"{chat_folder}/{safe_name}"
+                            if rel_path in used_rel_paths:
+                                base, ext = os.path.splitext(safe_name)
+                                safe_name = f"{base}_{i}{ext}"
+                                rel_path = f"{chat_folder}/{safe_name}"
+                            used_rel_paths.add(rel_path)
+                            chat_dir = chat_dirs.get(chat_folder)
+                            if chat_dir is None:
+                                chat_dir = chat_dirs[chat_folder] = os.path.join(export_dir, chat_folder)
+                            file_list.append((orig_url, rel_path, os.path.join(chat_dir, safe_name)))
+
+                        # Папки выгрузки и чатов — одним вызовом в потоке
+                        await asyncio.to_thread(make_dirs, [export_dir, *chat_dirs.values()])
+
+                        # Zip собирается по ходу загрузки: каждый скачанный файл сразу дописывается (в потоке)
+                        zip_path = os.path.join(export_dir, "_files.zip")
+                        files_zip = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+                        zip_lock = asyncio.Lock()
+                        zip_ok = True
+
+                        async def _append_to_zip(dest_path, rel_path, size):
+                            nonlocal zip_ok
+                            async with zip_lock:
+                                if not zip_ok:
+                                    return
+                                try:
+                                    st = os.statvfs(export_dir)
+                                    free_bytes = st.f_bavail * st.f_frsize
+                                    if free_bytes < size + 100 * 1024 * 1024:
+                                        logger.warning("Not enough space for zip (%.0f MB free)", free_bytes / 1024**2)
+                                        zip_ok = False
+                                        return
+                                    await asyncio.to_thread(zip_append_file, files_zip, dest_path, rel_path)
+                                    _export_sizes[export_dir] = _export_sizes.get(export_dir, 0) + size
+                                except Exception as e:
+                                    logger.warning("Zip creation failed: %s", e)
+                                    zip_ok = False
+
+                        # Параллельная загрузка: 5 горутин одновременно
+                        dl_sem = asyncio.Semaphore(5)
+
+                        not_started: set[asyncio.Task] = set()  # Задачи, ещё ждущие семафор — их можно отменить
+
+                        def _stop_pending():
+                            """Лимит выгрузки достигнут — отменяем всё, что ещё не начало качать"""
+                            for t in not_started:
+                                t.cancel()
+                            not_started.clear()
+
+                        async def _download_one(orig_url, safe_name, dest_path):
+                            nonlocal downloaded_files, total_bytes
+                            async with dl_sem:
+                                not_started.discard(asyncio.current_task())
+                                if total_bytes >= MAX_EXPORT_SIZE:
+                                    return
+                                try:
+                                    file_id = orig_url.rstrip("/").split("/")[-1]
+                                    dlink = await client.get_file_dlink(file_id)
+                                    if not dlink:
+                                        logger.info("No dlink for %s (file_id=%s)", safe_name, file_id)
+                                        return
+                                    size = await client.stream_file(dlink, dest_path, max_size=500 * 1024 * 1024)
+                                    if size:
+                                        downloaded_files += 1
+                                        total_bytes += size
+                                        _export_sizes[export_dir] = _export_sizes.get(export_dir, 0) + size
+                                        files_url_map[orig_url] = f"{config.PUBLIC_URL}/files/{export_uuid}/{safe_name}"
+                                        if total_bytes >= MAX_EXPORT_SIZE:
+                                            _stop_pending()
+                                        await _append_to_zip(dest_path, safe_name, size)
+                                except Exception as e:
+                                    logger.warning("Error downloading %s: %s", safe_name, e)
+
+                        tasks = [asyncio.create_task(_download_one(url, name, path)) for url, name, path in file_list]
+                        not_started.update(tasks)
+                        completed = 0
+                        progress_step = max(1, total_files // 20)
+                        last_shown = 0
+                        for coro in asyncio.as_completed(tasks):
+                            try:
+                                await coro
+                            except asyncio.CancelledError:
+                                if asyncio.current_task().cancelling():
+                                    # Отменили сам экспорт — останавливаем загрузки и пробрасываем отмену
+                                    for t in tasks:
+                                        t.cancel()
+                                    raise
+                                # Иначе это загрузка, отменённая по лимиту размера выгрузки
+                            completed += 1
+                            if completed - last_shown >= progress_step or completed == total_files:
+                                last_shown = completed
+                                status.update(
+                                    f"📎 <b>Загрузка файлов</b>\n\n"
+                                    f"{make_progress_bar(completed, total_files)}\n\n"
+                                    f"Загружено: {downloaded_files}/{total_files} ({total_bytes / 1024**2:.1f} MB)",
+                                    parse_mode="HTML"
+                                )
+
+                        logger.info("Files downloaded: %d/%d, %.1f MB total", downloaded_files, total_files, total_bytes / 1024**2)
+
+                        # Подставляем дубли по имени → на скачанный файл в HTML
+                        for dup_url, first_url in duplicate_url_map.items():
+                            if first_url in files_url_map:
+                                files_url_map[dup_url] = files_url_map[first_url]
+
+                        # Закрываем zip (пишется центральный каталог)
+                        try:
+                            await asyncio.to_thread(files_zip.close)
+                        except Exception as e:
+                            logger.warning("Zip creation failed: %s", e)
+                            zip_ok = False
+                    finally:
+                        _exports_writing.discard(export_dir)
+
+                    if downloaded_files > 0 and zip_ok:
+                        files_zip_url = f"{config.PUBLIC_URL}/files/{export_uuid}/download"
+                        files_zip_size_mb = os.path.getsize(zip_path) / 1024**2
+                        logger.info("Created _files.zip: %.1f MB", files_zip_size_mb)
+                        # Запоминаем для блокировки повторной выгрузки с файлами
+                        user_active_exports[user_id] = {
+                            "uuid": export_uuid,
+                            "path": export_dir,
+                            "created_monotonic": time.monotonic(),
+                        }
+                    else:
+                        try:
+                            os.remove(zip_path)
+                        except OSError:
+                            pass
 
-                # Подставляем дубли по имени → на скачанный файл в HTML
-                for dup_url, first_url in duplicate_url_map.items():
-                    if first_url in files_url_map:
-                        files_url_map[dup_url] = files_url_map[first_url]
+        # Формируем итоговый экспорт (даже при ошибках — отдаём что собрали)
+        final_export = {
+            "export_date": datetime.now().isoformat(),
+            "total_chats": len(all_exports),
+            "chats": all_exports
+        }
 
-                # Собираем zip из скачанных файлов
-                if downloaded_files > 0:
-                    try:
-                        st = os.statvfs(export_dir)
-                        free_bytes = st.f_bavail * st.f_frsize
-                        if free_bytes < total_bytes + 100 * 1024 * 1024:
-                            print(f"📎 Not enough space for zip ({free_bytes / 1024**2:.0f} MB free, need {total_bytes / 1024**2:.0f} MB)")
+        # Создаём файлы и упаковываем в ZIP (только для html/json/both, не для files_only)
+        if format_type != "files_only":
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+            try:
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    # Участники архива: [(arcname, write, size_hint)] — write(out) пишет содержимое прямо в ZIP
+                    members = []
+                    # Оценка сверху для обоих форматов (HTML к тому же встраивает аватарки)
+                    export_size = estimate_export_size(final_export, avatars)
+
+                    if format_type in ("html", "both"):
+                        html_filename = f"vkteams_export_{timestamp}.html"
+
+                        if total_msgs == 0:
+                            # Нет ни одного сообщения — шаблон, имена и статус не нужны
+                            members.append((html_filename, partial(
+                                write_text_member, text="<html><body><h1>Нет сообщений для экспорта</h1></body></html>"
+                            ), 0))
                         else:
-                            zip_path = os.path.join(export_dir, "_files.zip")
-                            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
-                                for dirpath, dirnames, filenames in os.walk(export_dir):
-                                    for fname in sorted(filenames):
-                                        if fname == "_files.zip":
-                                            continue
-                                        full_path = os.path.join(dirpath, fname)
-                                        arcname = os.path.relpath(full_path, export_dir)
-                                        zf.write(full_path, arcname)
-                            files_zip_url = f"{config.PUBLIC_URL}/files/{export_uuid}/download"
-                            files_zip_size_mb = os.path.getsize(zip_path) / 1024**2
-                            print(f"📎 Created _files.zip: {files_zip_size_mb:.1f} MB")
-                            # Запоминаем для блокировки повторной выгрузки с файлами
-                            user_active_exports[user_id] = {
-                                "uuid": export_uuid,
-                                "path": export_dir,
-                                "created_at": datetime.now().timestamp(),
+                            # Создаём словарь имён из контактов
+                            # Используем имя только если это не email/sn
+                            names = {
+                                sn: name
+                                for contact in all_chats
+                                if (sn := contact.get("sn"))
+                                and (name := contact.get("name") or contact.get("friendly"))
+                                and name != sn and "@" not in name
                             }
-                    except Exception as e:
-                        print(f"📎 Zip creation failed: {e}")
-
-    # Формируем итоговый экспорт (даже при ошибках — отдаём что собрали)
-    final_export = {
-        "export_date": datetime.now().isoformat(),
-        "total_chats": len(all_exports),
-        "chats": all_exports
-    }
-
-    # Создаём файлы и упаковываем в ZIP (только для html/json/both, не для files_only)
-    if format_type != "files_only":
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-        try:
-            with tempfile.TemporaryDirectory() as tmpdir:
-                # Создаём файлы внутри архива
-                files_for_zip = []
-
-                if format_type in ("json", "both"):
-                    json_filename = f"vkteams_export_{timestamp}.json"
-                    json_path = os.path.join(tmpdir, json_filename)
-                    with open(json_path, "w", encoding="utf-8") as f:
-                        json.dump(final_export, f, ensure_ascii=False, indent=2)
-                    files_for_zip.append((json_path, json_filename))
-
-                if format_type in ("html", "both"):
-                    html_filename = f"vkteams_export_{timestamp}.html"
-                    html_path = os.path.join(tmpdir, html_filename)
-
-                    # Создаём словарь имён из контактов
-                    names = {}
-                    for contact in all_chats:
-                        sn = contact.get("sn", "")
-                        name = contact.get("name") or contact.get("friendly") or ""
-                        # Используем имя только если это не email/sn
-                        if sn and name and name != sn and "@" not in name:
-                            names[sn] = name
-                    print(f"👤 Loaded contact names: {len(names)} entries")
-                    print(f"📷 Total avatars collected: {len(avatars)}")
-
-                    # Статус: генерация HTML
-                    await safe_edit_text(
-                        status_msg,
-                        f"⏳ <b>Генерация HTML...</b>\n\n"
-                        f"📊 Чатов: {len(all_exports)}\n"
-                        f"📝 Сообщений: {total_msgs}\n"
-                        f"📷 Аватарок: {len(avatars)}\n"
-                        f"📎 Файлов: {len(files_url_map)}\n"
-                        f"👤 Контактов: {len(names)}\n\n"
-                        f"Это может занять время для больших экспортов",
-                        parse_mode="HTML"
-                    )
+                            logger.info("Loaded contact names: %d entries", len(names))
+                            logger.info("Total avatars collected: %d", len(avatars))
+
+                            # Статус: генерация HTML
+                            status.update(
+                                f"⏳ <b>Генерация HTML...</b>\n\n"
+                                f"📊 Чатов: {len(all_exports)}\n"
+                                f"📝 Сообщений: {total_msgs}\n"
+                                f"📷 Аватарок: {len(avatars)}\n"
+                                f"📎 Файлов: {len(files_url_map)}\n"
+                                f"👤 Контактов: {len(names)}\n\n"
+                                f"Это может занять время для больших экспортов",
+                                parse_mode="HTML"
+                            )
+                            logger.info("Generating HTML for %d chats, %d messages", len(all_exports), total_msgs)
+                            members.append((html_filename, partial(
+                                write_html_member, data=final_export, avatars=avatars, names=names, files_url_map=files_url_map
+                            ), export_size))
+
+                    # JSON — после HTML: если рендер HTML упадёт, JSON ещё не сериализован
+                    if format_type in ("json", "both"):
+                        members.append((f"vkteams_export_{timestamp}.json", partial(write_json_member, data=final_export), export_size))
+
+                    # Создаём ZIP архив: сначала быстрое сжатие
+                    zip_filename = f"vkteams_export_{timestamp}.zip"
+                    zip_path = os.path.join(tmpdir, zip_filename)
 
                     try:
-                        print(f"📝 Generating HTML for {len(all_exports)} chats, {total_msgs} messages...")
-                        html_content = format_as_html(final_export, avatars=avatars, names=names, files_url_map=files_url_map)
-                        print(f"✅ HTML generated: {len(html_content)} bytes")
-                    except Exception as html_err:
-                        print(f"❌ HTML generation error: {html_err}")
+                        raw_size = await asyncio.to_thread(build_export_zip, zip_path, members, config.ZIP_COMPRESSLEVEL)
+                    except _HtmlRenderError as html_err:
+                        # HTML не собрался — пересобираем архив со страницей ошибки вместо него
+                        logger.error("HTML generation error: %s", html_err)
                         errors.append(f"HTML форматирование: {html_err}")
-                        html_content = f"<html><body><h1>Ошибка форматирования</h1><pre>{html_err}</pre></body></html>"
-
-                    with open(html_path, "w", encoding="utf-8") as f:
-                        f.write(html_content)
-                    files_for_zip.append((html_path, html_filename))
-
-                    # Освобождаем память
-                    del html_content
-                    gc.collect()
-
-                # Создаём ZIP архив с максимальным сжатием
-                zip_filename = f"vkteams_export_{timestamp}.zip"
-                zip_path = os.path.join(tmpdir, zip_filename)
-
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
-                    for file_path, arcname in files_for_zip:
-                        zf.write(file_path, arcname)
-
-                # Проверяем размер ZIP
-                zip_size_mb = os.path.getsize(zip_path) / (1024 * 1024)
-
-                # Отправляем файл
-                status_text = "✅ <b>Экспорт завершён!</b>" if not critical_error else "⚠️ <b>Экспорт завершён с ошибками</b>"
-                await safe_edit_text(
-                    status_msg,
-                    f"{status_text}\n\n"
-                    f"📊 Чатов: {len(all_exports)}\n"
-                    f"📦 Размер архива: {zip_size_mb:.1f} MB\n"
-                    f"📨 Отправляю файл...",
-                    parse_mode="HTML"
-                )
-
-                if zip_size_mb > 50:
-                    await callback.message.answer(
-                        f"⚠️ Архив слишком большой ({zip_size_mb:.1f} MB).\n"
-                        f"Лимит Telegram: 50 MB.\n\n"
-                        f"Попробуйте экспортировать меньше чатов.",
+                        members[0] = (html_filename, partial(
+                            write_text_member,
+                            text=f"<html><body><h1>Ошибка форматирования</h1><pre>{html_err}</pre></body></html>"
+                        ), 0)
+                        raw_size = await asyncio.to_thread(build_export_zip, zip_path, members, config.ZIP_COMPRESSLEVEL)
+                    logger.info("Export archive built: %d bytes uncompressed", raw_size)
+
+                    # Проверяем размер ZIP
+                    zip_size_mb = os.path.getsize(zip_path) / (1024 * 1024)
+
+                    # Не влезли в лимит Telegram — пережимаем готовый архив сильнее (без повторной генерации)
+                    if zip_size_mb > config.MAX_FILE_SIZE_MB and config.ZIP_COMPRESSLEVEL < config.ZIP_FALLBACK_COMPRESSLEVEL:
+                        await asyncio.to_thread(recompress_zip, zip_path, config.ZIP_FALLBACK_COMPRESSLEVEL)
+                        zip_size_mb = os.path.getsize(zip_path) / (1024 * 1024)
+
+                    # Отправляем файл
+                    status_text = "✅ <b>Экспорт завершён!</b>" if not critical_error else "⚠️ <b>Экспорт завершён с ошибками</b>"
+                    status.update(
+                        f"{status_text}\n\n"
+                        f"📊 Чатов: {len(all_exports)}\n"
+                        f"📦 Размер архива: {zip_size_mb:.1f} MB\n"
+                        f"📨 Отправляю файл...",
                         parse_mode="HTML"
                     )
-                else:
-                    try:
-                        # Отправка с retry логикой и exponential backoff
-                        caption = (
-                            f"📦 VK Teams Export ({format_type.upper()})\n"
-                            f"📊 {len(all_exports)} чатов, {sum(e.get('total_messages', 0) for e in all_exports)} сообщений"
-                        )
-                        await send_document_with_retry(
-                            callback.bot,
-                            callback.message.chat.id,
-                            zip_path,
-                            caption,
-                            max_retries=4
-                        )
-                    except (asyncio.TimeoutError, TelegramNetworkError) as e:
+
+                    if zip_size_mb > config.MAX_FILE_SIZE_MB:
+                        # Заведомо не пройдёт — не читаем и не отправляем файл
                         await callback.message.answer(
-                            f"⚠️ Не удалось отправить файл после 4 попыток.\n"
-                            f"Ошибка: {e}\n\n"
-                            f"Попробуйте экспортировать меньше чатов или повторите позже.\n"
-                            f"При проблемах обратитесь: <code>{SUPPORT_CONTACT}</code>",
+                            f"⚠️ Архив слишком большой ({zip_size_mb:.1f} MB).\n"
+                            f"Лимит Telegram: {config.MAX_FILE_SIZE_MB} MB.\n\n"
+                            f"Попробуйте экспортировать меньше чатов.",
                             parse_mode="HTML"
                         )
+                    else:
+                        try:
+                            # Отправка с retry логикой и exponential backoff
+                            caption = (
+                                f"📦 VK Teams Export ({format_type.upper()})\n"
+                                f"📊 {len(all_exports)} чатов, {total_msgs} сообщений"
+                            )
+                            await send_document_with_retry(
+                                callback.bot,
+                                callback.message.chat.id,
+                                zip_path,
+                                caption,
+                                max_retries=4
+                            )
+                        except (asyncio.TimeoutError, TelegramNetworkError, TelegramServerError, TelegramRetryAfter) as e:
+                            await callback.message.answer(
+                                f"⚠️ Не удалось отправить файл после 4 попыток.\n"
+                                f"Ошибка: {e}\n\n"
+                                f"Попробуйте экспортировать меньше чатов или повторите позже.\n"
+                                f"При проблемах обратитесь: <code>{SUPPORT_CONTACT}</code>",
+                                parse_mode="HTML"
+                            )
+
+            except Exception as file_err:
+                await callback.message.answer(
+                    f"❌ Ошибка при создании файлов: {file_err}\n\n"
+                    f"При проблемах обратитесь: <code>{SUPPORT_CONTACT}</code>",
+                    parse_mode="HTML"
+                )
 
-        except Exception as file_err:
-            await callback.message.answer(
-                f"❌ Ошибка при создании файлов: {file_err}\n\n"
-                f"При проблемах обратитесь: <code>{SUPPORT_CONTACT}</code>",
-                parse_mode="HTML"
-            )
-
-    # Итоговое сообщение
-    error_text = ""
-    if critical_error:
-        error_text = f"\n\n❌ Критическая ошибка: {critical_error}"
-    if errors:
-        error_text += f"\n\n⚠️ Ошибки ({len(errors)}):\n" + "\n".join(errors[:5])
-        if len(errors) > 5:
-            error_text += f"\n... и ещё {len(errors) - 5}"
-    if no_dialogs:
-        # Получаем имена контактов без диалогов
-        no_dialog_names = []
-        for sn in no_dialogs[:5]:
-            chat_info = next((c for c in all_chats if c.get("sn") == sn), {})
-            name = chat_info.get("name") or chat_info.get("friendly") or sn
-            no_dialog_names.append(name)
-
-        error_text += f"\n\nℹ️ Нет диалога ({len(no_dialogs)}): " + ", ".join(no_dialog_names)
-        if len(no_dialogs) > 5:
-            error_text += f" и ещё {len(no_dialogs) - 5}"
-
-    if no_access:
-        # Получаем имена чатов для которых нет доступа
-        no_access_names = []
-        for sn in no_access[:5]:
-            chat_info = next((c for c in all_chats if c.get("sn") == sn), {})
-            name = chat_info.get("name") or chat_info.get("friendly") or sn
-            no_access_names.append(name)
-
-        error_text += f"\n\n🚫 Нет доступа ({len(no_access)}): " + ", ".join(no_access_names)
-        if len(no_access) > 5:
-            error_text += f" и ещё {len(no_access) - 5}"
-        error_text += "\n<i>Возможные причины: заблокирован, удалён из чата, или служебный чат</i>"
-
-    support_text = ""
-    if critical_error or errors:
-        support_text = f"\n\nПри проблемах обратитесь: <code>{SUPPORT_CONTACT}</code>"
-
-    log_event("export_complete", user_id, f"chats={len(all_exports)},messages={total_msgs},errors={len(errors)},no_dialogs={len(no_dialogs)},no_access={len(no_access)}")
-
-    # Обновляем статус экспорта пользователя для мониторинга
-    update_user_export(user_id, success=not critical_error and not errors, errors=errors if errors else None)
-
-    files_text = ""
-    files_keyboard = None
-    if files_url_map:
-        if files_zip_url:
-            files_text = (
-                f'\n📎 Файлов: {len(files_url_map)} → '
-                f'<a href="{files_zip_url}">скачать zip ({files_zip_size_mb:.1f} МБ)</a>\n'
-                f'⏰ Ссылка на файлы доступна 10 минут\n'
-                f'⚠️ <b>Важно:</b> выгрузка файлов работает только из РФ. Если у вас VPN — отключите его перед скачиванием.'
-            )
-            files_keyboard = InlineKeyboardBuilder()
-            files_keyboard.button(text="🗑️ Удалить файлы", callback_data=f"delete_files:{export_uuid}")
-        else:
-            files_text = f"\n📎 Файлов в HTML: {len(files_url_map)}"
-
-    await callback.message.answer(
-        f"{'✅' if not critical_error else '⚠️'} <b>Экспорт завершён</b>\n\n"
-        f"📊 Экспортировано: {len(all_exports)} из {len(selected)} чатов\n"
-        f"📝 Всего сообщений: {total_msgs}"
-        f"{files_text}"
-        f"{error_text}{support_text}",
-        reply_markup=files_keyboard.as_markup() if files_keyboard else None,
-        parse_mode="HTML"
-    )
-
-    # Снимаем блокировку и очищаем состояние
-    user_exporting.pop(user_id, None)
-    await state.clear()
-    user_selected_chats.pop(user_id, None)
-    user_search_query.pop(user_id, None)
+        # Итоговое сообщение
+        error_text = ""
+        if critical_error:
+            error_text = f"\n\n❌ Критическая ошибка: {critical_error}"
+        if errors:
+            error_text += f"\n\n⚠️ Ошибки ({len(errors)}):\n" + "\n".join(errors[:5])
+            if len(errors) > 5:
+                error_text += f"\n... и ещё {len(errors) - 5}"
+        if no_dialogs:
+            # Получаем имена контактов без диалогов
+            no_dialog_names = []
+            for sn in no_dialogs[:5]:
+                chat_info = chats_by_sn.get(sn, {})
+                name = chat_info.get("name") or chat_info.get("friendly") or sn
+                no_dialog_names.append(name)
+
+            error_text += f"\n\nℹ️ Нет диалога ({len(no_dialogs)}): " + ", ".join(no_dialog_names)
+            if len(no_dialogs) > 5:
+                error_text += f" и ещё {len(no_dialogs) - 5}"
+
+        if no_access:
+            # Получаем имена чатов для которых нет доступа
+            no_access_names = []
+            for sn in no_access[:5]:
+                chat_info = chats_by_sn.get(sn, {})
+                name = chat_info.get("name") or chat_info.get("friendly") or sn
+                no_access_names.append(name)
+
+            error_text += f"\n\n🚫 Нет доступа ({len(no_access)}): " + ", ".join(no_access_names)
+            if len(no_access) > 5:
+                error_text += f" и ещё {len(no_access) - 5}"
+            error_text += "\n<i>Возможные причины: заблокирован, удалён из чата, или служебный чат</i>"
+
+        support_text = ""
+        if critical_error or errors:
+            support_text = f"\n\nПри проблемах обратитесь: <code>{SUPPORT_CONTACT}</code>"
+        # Дописываем последний статус до итогового сообщения
+        await status.close()
+
+        log_event("export_complete", user_id, f"chats={len(all_exports)},messages={total_msgs},errors={len(errors)},no_dialogs={len(no_dialogs)},no_access={len(no_access)}")
+
+        # Обновляем статус экспорта пользователя для мониторинга
+        update_user_export(user_id, success=not critical_error and not errors, errors=errors if errors else None)
+
+        files_text = ""
+        files_keyboard = None
+        if files_url_map:
+            if files_zip_url:
+                files_text = (
+                    f'\n📎 Файлов: {len(files_url_map)} → '
+                    f'<a href="{files_zip_url}">скачать zip ({files_zip_size_mb:.1f} МБ)</a>\n'
+                    f'⏰ Ссылка на файлы доступна 10 минут\n'
+                    f'⚠️ <b>Важно:</b> выгрузка файлов работает только из РФ. Если у вас VPN — отключите его перед скачиванием.'
+                )
+                files_keyboard = InlineKeyboardBuilder()
+                files_keyboard.button(text="🗑️ Удалить файлы", callback_data=f"delete_files:{export_uuid}")
+            else:
+                files_text = f"\n📎 Файлов в HTML: {len(files_url_map)}"
+
+        await callback.message.answer(
+            f"{'✅' if not critical_error else '⚠️'} <b>Экспорт завершён</b>\n\n"
+            f"📊 Экспортировано: {len(all_exports)} из {len(selected)} чатов\n"
+            f"📝 Всего сообщений: {total_msgs}"
+            f"{files_text}"
+            f"{error_text}{support_text}",
+            reply_markup=files_keyboard.as_markup() if files_keyboard else None,
+            parse_mode="HTML"
+        )
+    finally:
+        if status is not None:
+            await status.close()  # После штатного close ничего не делает; при ошибке или отмене останавливает писателя
+        # Снимаем блокировку и очищаем состояние — даже если экспорт упал или отменён
+        user_exporting.pop(user_id, None)
+        user_selected_chats.pop(user_id, None)
+        user_search_query.pop(user_id, None)
+        user_keyboard_cache.pop(user_id, None)
+        user_contacts_cache.pop(user_id, None)
+        user_filter_cache.pop(user_id, None)
+        try:
+            await state.clear()
+        finally:
+            if released:
+                await lock.acquire()  # serialize_user_middleware отпустит его сам
 
 
 @router.message(Command("export"))
@@ -1789,16 +2479,15 @@ async def _notify_admins(text: str):
         try:
             await _bot.send_message(admin_id, text, parse_mode="HTML")
         except Exception as e:
-            print(f"Failed to notify admin {admin_id}: {e}")
+            logger.warning("Failed to notify admin %s: %s", admin_id, e)
 
 
 async def _auto_disable_files(minutes: int = 20):
     """Автовыключить файлы для всех из-за лимита диска; запустить таймер включения"""
     global _files_enabled, _files_auto_reenable_at
     _files_enabled = False
-    _files_auto_reenable_at = datetime.now().timestamp() + minutes * 60
-    set_setting("files_enabled", "0")
-    set_setting("files_auto_reenable_at", str(_files_auto_reenable_at))
+    _files_auto_reenable_at = time.time() + minutes * 60
+    set_settings({"files_enabled": "0", "files_auto_reenable_at": str(_files_auto_reenable_at)})
     log_event("auto_files_off", data=f"disk_limit={config.MAX_DISK_GB}GB, reenable_in={minutes}min")
 
     await _notify_admins(
@@ -1813,7 +2502,7 @@ async def _auto_disable_files(minutes: int = 20):
 
 async def _scheduled_reenable_task(expected_at: float):
     """Фоновая задача: спать до expected_at, затем включить файлы (если не отменено)"""
-    sleep_sec = max(0, expected_at - datetime.now().timestamp())
+    sleep_sec = max(0, expected_at - time.time())
     if sleep_sec > 0:
         await asyncio.sleep(sleep_sec)
 
@@ -1824,8 +2513,7 @@ async def _scheduled_reenable_task(expected_at: float):
 
     _files_enabled = True
     _files_auto_reenable_at = None
-    set_setting("files_enabled", "1")
-    set_setting("files_auto_reenable_at", "")
+    set_settings({"files_enabled": "1", "files_auto_reenable_at": ""})
     log_event("auto_files_on", data="auto_reenable after disk limit timeout")
 
     await _notify_admins(
@@ -1834,6 +2522,28 @@ async def _scheduled_reenable_task(expected_at: float):
     )
 
 
+async def send_to_users(bot: Bot, user_ids, message_text: str) -> tuple[int, int]:
+    """Send message to many users concurrently within Telegram rate limits
+    Рассылка идёт ниже общего лимита (_broadcast_limiter), чтобы ответы остальным не вставали в очередь;
+    flood control (retry_after) повторяет TelegramRateLimiter. Семафор ограничивает число запросов в полёте.
+    Returns: (sent_count, failed_count)
+    """
+    sem = asyncio.Semaphore(config.BROADCAST_CONCURRENCY)
+
+    async def _one(user_id) -> bool:
+        async with sem, _broadcast_limiter:
+            try:
+                await bot.send_message(user_id, message_text, parse_mode="HTML")
+                return True
+            except Exception as e:
+                logger.debug("Failed to send message to %s: %s", user_id, e)
+                return False
+
+    results = await asyncio.gather(*(_one(user_id) for user_id in user_ids))
+    sent = sum(results)
+    return sent, len(results) - sent
+
+
 async def broadcast_message(bot: Bot, message_text: str, exclude_user_id: int = None) -> tuple[int, int]:
     """Broadcast message to all active users
     Returns: (sent_count, failed_count)
@@ -1845,19 +2555,7 @@ async def broadcast_message(bot: Bot, message_text: str, exclude_user_id: int =
     if exclude_user_id:
         all_user_ids.discard(exclude_user_id)
 
-    sent = 0
-    failed = 0
-
-    for user_id in all_user_ids:
-        try:
-            await bot.send_message(user_id, message_text, parse_mode="HTML")
-            sent += 1
-        except Exception:
-            failed += 1
-
-        await asyncio.sleep(0.05)  # Rate limit
-
-    return sent, failed
+    return await send_to_users(bot, all_user_ids, message_text)
 
 
 @router.message(Command("maintenance"))
@@ -1940,7 +2638,6 @@ async def cmd_announce_update(message: Message):
     )
 
 
-@router.callback_query(F.data.startswith("broadcast:"))
 async def handle_broadcast_confirm(callback: CallbackQuery):
     """Подтверждение или отмена рассылки"""
     if callback.from_user.id not in config.ADMIN_IDS:
@@ -1958,17 +2655,30 @@ async def handle_broadcast_confirm(callback: CallbackQuery):
         )
         return
 
-    # Подтверждение — отправляем
+    # Подтверждение — отправляем в фоне, чтобы не держать обработчик всю рассылку
     await callback.answer()
     await callback.message.edit_text(
         "⏳ <b>Отправляю уведомления...</b>",
         parse_mode="HTML"
     )
 
-    sent, failed = await broadcast_message(callback.bot, broadcast_text, exclude_user_id=callback.from_user.id)
+    task = asyncio.create_task(_run_broadcast(callback, broadcast_text))
+    _broadcast_tasks.add(task)
+    task.add_done_callback(_broadcast_tasks.discard)
+
+
+async def _run_broadcast(callback: CallbackQuery, broadcast_text: str):
+    """Фоновая рассылка: отправка всем и итог в сообщении админа"""
+    try:
+        sent, failed = await broadcast_message(callback.bot, broadcast_text, exclude_user_id=callback.from_user.id)
+    except Exception as e:
+        logger.error("Broadcast failed: %s", e)
+        await safe_edit_text(callback.message, "❌ <b>Рассылка прервана</b>\n\nПодробности — в логах бота.", parse_mode="HTML")
+        return
     log_event("broadcast_sent", callback.from_user.id, data=f"sent={sent} failed={failed}")
 
-    await callback.message.edit_text(
+    await safe_edit_text(
+        callback.message,
         f"✅ <b>Уведомление отправлено</b>\n\n"
         f"📨 Успешно: {sent}\n"
         f"❌ Не доставлено: {failed}",
@@ -1995,7 +2705,7 @@ async def cmd_admin(message: Message):
     status = "✅ <b>включены</b>" if _files_enabled else "❌ <b>выключены</b>"
     auto_info = ""
     if _files_auto_reenable_at and not _files_enabled:
-        remaining_min = max(0, round((_files_auto_reenable_at - datetime.now().timestamp()) / 60))
+        remaining_min = max(0, round((_files_auto_reenable_at - time.time()) / 60))
         auto_info = f"\n⏰ Автоматически включат через {remaining_min} мин"
     await message.answer(
         f"🔧 <b>Управление файлами</b>\n\n"
@@ -2006,7 +2716,6 @@ async def cmd_admin(message: Message):
     )
 
 
-@router.callback_query(F.data.startswith("admin_toggle:"))
 async def handle_admin_toggle(callback: CallbackQuery):
     """Тогл глобальных настроек"""
     if callback.from_user.id not in config.ADMIN_IDS:
@@ -2022,12 +2731,11 @@ async def handle_admin_toggle(callback: CallbackQuery):
     if action == "files_on":
         _files_enabled = True
         _files_auto_reenable_at = None  # отменяем автовыключение если было
-        set_setting("files_enabled", "1")
-        set_setting("files_auto_reenable_at", "")
+        set_settings({"files_enabled": "1", "files_auto_reenable_at": ""})
         log_event("admin_files_on", callback.from_user.id)
     else:
         _files_enabled = False
-        set_setting("files_enabled", "0")
+        set_settings({"files_enabled": "0"})
         log_event("admin_files_off", callback.from_user.id)
 
     builder = InlineKeyboardBuilder()
@@ -2040,7 +2748,7 @@ async def handle_admin_toggle(callback: CallbackQuery):
     status = "✅ <b>включены</b>" if _files_enabled else "❌ <b>выключены</b>"
     auto_info = ""
     if _files_auto_reenable_at and not _files_enabled:
-        remaining_min = max(0, round((_files_auto_reenable_at - datetime.now().timestamp()) / 60))
+        remaining_min = max(0, round((_files_auto_reenable_at - time.time()) / 60))
         auto_info = f"\n⏰ Автоматически включат через {remaining_min} мин"
     await callback.message.edit_text(
         f"🔧 <b>Управление файлами</b>\n\n"
@@ -2057,6 +2765,53 @@ async def handle_admin_toggle(callback: CallbackQuery):
 _bot: Optional[Bot] = None
 
 
+# ============== Callback routing ==============
+
+# Все inline-кнопки маршрутизируются одним хэндлером: словарь вместо цепочки
+# F.data-фильтров, которые aiogram проверял бы по очереди для каждого callback
+_CALLBACK_EXACT = {
+    "do_logout": handle_logout,
+    "go_to_chats": handle_go_to_chats,
+    "show_private": show_private_chats,
+    "show_groups": show_group_chats,
+    "show_hidden": show_hidden_chats,
+    "noop": handle_noop,
+    "clear_selection": clear_selection,
+    "start_search": start_search,
+    "cancel_search": cancel_search,
+    "clear_search": clear_search,
+    "do_export": do_export,
+}
+_CALLBACK_PREFIX = {  # callback_data вида "<prefix>:<arg>"
+    "page": handle_pagination,
+    "select": toggle_chat_selection,
+    "select_all": select_all_current,
+    "avatars": ask_export_format,
+    "format": process_export,
+    "files": handle_files_choice,
+    "delete_files": handle_delete_files,
+    "broadcast": handle_broadcast_confirm,
+    "admin_toggle": handle_admin_toggle,
+}
+# Хэндлеры без FSM — вызываются только с callback
+_CALLBACK_STATELESS = frozenset({handle_noop, handle_delete_files, handle_broadcast_confirm, handle_admin_toggle})
+
+
+@router.callback_query()
+async def dispatch_callback(callback: CallbackQuery, state: FSMContext):
+    """Маршрутизация callback по точному значению или префиксу до ':'"""
+    data = callback.data or ""
+    handler = _CALLBACK_EXACT.get(data)
+    if handler is None:
+        prefix, sep, _ = data.partition(":")
+        if sep:
+            handler = _CALLBACK_PREFIX.get(prefix)
+    if handler in _CALLBACK_STATELESS:
+        await handler(callback)
+    elif handler is not None:
+        await handler(callback, state)
+
+
 async def notify_users_shutdown():
     """Notify active users that bot is shutting down"""
     if not _bot:
@@ -2072,39 +2827,86 @@ async def notify_users_shutdown():
         if not all_user_ids:
             return
 
-        print(f"Notifying {len(all_user_ids)} users about shutdown...")
-
-        for user_id in all_user_ids:
-            try:
-                await _bot.send_message(
-                    user_id,
-                    "⚠️ <b>Бот временно выключается</b>\n\n"
-                    "Проводятся технические работы.\n"
-                    "Бот скоро снова будет доступен.\n\n"
-                    f"При вопросах: <code>{SUPPORT_CONTACT}</code>",
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                print(f"Failed to notify user {user_id}: {e}")
+        logger.info("Notifying %d users about shutdown...", len(all_user_ids))
 
-            await asyncio.sleep(0.1)  # Rate limit
+        sent, failed = await send_to_users(
+            _bot,
+            all_user_ids,
+            "⚠️ <b>Бот временно выключается</b>\n\n"
+            "Проводятся технические работы.\n"
+            "Бот скоро снова будет доступен.\n\n"
+            f"При вопросах: <code>{SUPPORT_CONTACT}</code>",
+        )
+        logger.info("Shutdown notice: sent %d, failed %d", sent, failed)
 
     except Exception as e:
-        print(f"Error notifying users: {e}")
+        logger.error("Error notifying users: %s", e)
+
+
+def create_fsm_storage():
+    """FSM storage: Redis если задан REDIS_URL, иначе память процесса (None → MemoryStorage)
+
+    В FSM хранятся только лёгкие ключи (auth_email, current_mode, current_page, параметры экспорта),
+    списки чатов живут в user_contacts_cache.
+    """
+    if not config.REDIS_URL:
+        return None
+
+    from aiogram.fsm.storage.redis import RedisStorage
+    import orjson
+
+    print("🗄 FSM storage: Redis")
+    return RedisStorage.from_url(
+        config.REDIS_URL,
+        json_loads=orjson.loads,
+        json_dumps=lambda obj: orjson.dumps(obj).decode(),
+    )
+
+
+def setup_log_queue() -> QueueListener:
+    """Вынести запись логов в отдельный поток, чтобы не блокировать event loop"""
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
 
 
 async def main():
-    global _bot
+    global _bot, _session_store
 
     if not config.TG_BOT_TOKEN:
         print("❌ Установите TG_BOT_TOKEN в .env файле!")
         print("   Получить токен: @BotFather в Telegram")
         return
 
+    # force=True — заменяет обработчики, если их успел поставить какой-то импорт
+    logging.basicConfig(
+        level=config.LOG_LEVEL,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        force=True,
+    )
+    log_listener = setup_log_queue()
+
+    # Учёт места под выгрузки файлов: полный пересчёт только при старте
+    recount_export_sizes()
+    # Устаревшие выгрузки чистим в фоне: сразу при старте и далее каждые 2 минуты
+    janitor_task = asyncio.create_task(_exports_janitor())
+
     # Создаём бота с увеличенными таймаутами для больших файлов
     bot = Bot(token=config.TG_BOT_TOKEN)
+    # Все отправки и правки — через общий token bucket с паузой на flood control
+    bot.session.middleware(TelegramRateLimiter(config.TG_RATE_PER_SEC))
     _bot = bot
-    dp = Dispatcher()
+    dp = Dispatcher(storage=create_fsm_storage())
+
+    # Auth-сессии в Redis — переживают перезапуск бота
+    if config.REDIS_URL:
+        _session_store = RedisSessionStore(config.REDIS_URL, config.USER_STATE_TTL_HOURS * 3600)
     dp.include_router(router)
 
     # Устанавливаем команды бота (меню)
@@ -2132,26 +2934,26 @@ async def main():
 
     # Загружаем глобальный флаг файлов из DB
     global _files_enabled, _files_auto_reenable_at
-    _files_enabled = get_setting("files_enabled", "1") != "0"
+    settings = get_settings(["files_enabled", "files_auto_reenable_at"])
+    _files_enabled = settings.get("files_enabled", "1") != "0"
     print(f"📎 Files enabled: {_files_enabled}")
 
     # Проверяем автовыключение с предыдущего запуска
-    _reenable_str = get_setting("files_auto_reenable_at", "")
+    _reenable_str = settings.get("files_auto_reenable_at", "")
     if _reenable_str:
         try:
             _files_auto_reenable_at = float(_reenable_str)
-            if _files_auto_reenable_at > datetime.now().timestamp():
+            if _files_auto_reenable_at > time.time():
                 # Таймер ещё не истёк — держим выключенными и запускаем фоновую задачу
                 _files_enabled = False
                 asyncio.ensure_future(_scheduled_reenable_task(_files_auto_reenable_at))
-                remaining_min = round((_files_auto_reenable_at - datetime.now().timestamp()) / 60)
+                remaining_min = round((_files_auto_reenable_at - time.time()) / 60)
                 print(f"⏰ Auto-reenable scheduled, remaining: {remaining_min} min")
             else:
                 # Таймер уже истёк — включаем файлы
                 _files_enabled = True
                 _files_auto_reenable_at = None
-                set_setting("files_enabled", "1")
-                set_setting("files_auto_reenable_at", "")
+                set_settings({"files_enabled": "1", "files_auto_reenable_at": ""})
                 print("📎 Auto-reenable time passed, files re-enabled")
         except (ValueError, OSError):
             pass
@@ -2161,12 +2963,20 @@ async def main():
     print("   Остановка: Ctrl+C")
 
     try:
-        # Простой polling - aiogram сам обрабатывает сигналы
+        # Простой polling - aiogram сам обрабатывает сигналы.
+        # Каждый апдейт — отдельная задача; апдейты одного пользователя
+        # выстраивает в очередь serialize_user_middleware
         await dp.start_polling(bot)
     finally:
+        janitor_task.cancel()
         log_event("bot_stop", data="Bot stopped")
+        await asyncio.to_thread(flush_events)
         await bot.session.close()
+        await dp.storage.close()
+        if _session_store:
+            await _session_store.close()
         print("👋 Бот остановлен")
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -11,6 +11,10 @@ TG_BOT_TOKEN = os.getenv("TG_BOT_TOKEN", "")
 _admin_ids_str = os.getenv("ADMIN_IDS", "")
 ADMIN_IDS = [int(x.strip()) for x in _admin_ids_str.split(",") if x.strip().isdigit()]
 
+# Redis для FSM storage (опционально, пусто = хранить в памяти)
+# Пример: redis://localhost:6379/0
+REDIS_URL = os.getenv("REDIS_URL", "")
+
 # VK Teams API
 VKTEAMS_API_BASE = os.getenv("VKTEAMS_API_BASE", "https://u.myteam.vmailru.net/api/v139/rapi")
 VKTEAMS_AUTH_BASE = os.getenv("VKTEAMS_AUTH_BASE", "https://u.myteam.vmailru.net/auth")
@@ -19,6 +23,16 @@ VKTEAMS_AUTH_BASE = os.getenv("VKTEAMS_AUTH_BASE", "https://u.myteam.vmailru.net
 MESSAGES_PER_REQUEST = 900  # Максимум ~1000, используем 900 для надёжности
 DELAY_BETWEEN_REQUESTS = 0.3  # Уменьшено с 0.5 благодаря connection pooling
 MAX_FILE_SIZE_MB = 50  # Лимит Telegram для файлов
+UPLOAD_CHUNK_SIZE = 256 * 1024  # Размер чанка при потоковой отправке файла в Telegram (aiofiles)
+ZIP_COMPRESSLEVEL = int(os.getenv("ZIP_COMPRESSLEVEL", "1"))  # Сжатие ZIP экспорта (1 — быстро; при превышении лимита пережимаем сильнее)
+ZIP_FALLBACK_COMPRESSLEVEL = int(os.getenv("ZIP_FALLBACK_COMPRESSLEVEL", "6"))  # Повторное сжатие, если не влезли в лимит Telegram (6 ≈ 9 по размеру, в разы быстрее)
+MAX_PARALLEL_UPLOADS = int(os.getenv("MAX_PARALLEL_UPLOADS", "3"))  # Одновременных отправок архивов в Telegram (на весь бот)
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "3"))  # Чатов, экспортируемых параллельно в одной выгрузке
+AVATAR_WORKERS = int(os.getenv("AVATAR_WORKERS", "4"))  # Параллельных загрузчиков аватарок в одной выгрузке
+AVATAR_RATE_PER_SEC = float(os.getenv("AVATAR_RATE_PER_SEC", "5"))  # Общий лимит запросов аватарок в секунду
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))  # Одновременных отправок при рассылке
+BROADCAST_RATE_PER_SEC = float(os.getenv("BROADCAST_RATE_PER_SEC", "25"))  # Темп рассылки — ниже TG_RATE_PER_SEC, чтобы остальным пользователям оставался запас
+TG_RATE_PER_SEC = float(os.getenv("TG_RATE_PER_SEC", "30"))  # Общий темп отправок/правок сообщений бота
 
 # URL для раздачи файлов экспорта (без trailing slash)
 # Пример: http://89.208.231.122:8080
@@ -27,3 +41,11 @@ PUBLIC_URL = os.getenv("PUBLIC_URL", "http://localhost:8080")
 # Лимиты файлов экспорта
 MAX_DISK_GB = int(os.getenv("MAX_DISK_GB", "20"))      # Всего GB на машине для файлов экспорта
 MAX_EXPORT_GB = int(os.getenv("MAX_EXPORT_GB", "2"))   # Лимит одной выгрузки в GB
+
+# Пользовательское состояние в памяти (LRU + TTL)
+USER_STATE_MAX_USERS = int(os.getenv("USER_STATE_MAX_USERS", "50000"))  # Максимум пользователей в каждом словаре
+USER_STATE_TTL_HOURS = int(os.getenv("USER_STATE_TTL_HOURS", "24"))     # Вытеснять после N часов неактивности
+CONTACTS_CACHE_TTL = int(os.getenv("CONTACTS_CACHE_TTL", "300"))        # Секунд хранить список контактов в Redis
+
+# Логирование (INFO — ход экспортов; в проде можно WARNING)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
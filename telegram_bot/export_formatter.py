@@ -3,24 +3,68 @@
 Современный дизайн 2025 - тёмная/светлая тема с тёплыми акцентами
 """
 
+import io
 import json
 import base64
 from datetime import datetime
 from html import escape
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def format_as_json(data: dict) -> str:
-    """Форматирование в JSON"""
-    return json.dumps(data, ensure_ascii=False, indent=2)
+
+def format_as_json(data: dict) -> bytes:
+    """Форматирование в JSON (UTF-8 bytes, orjson если установлен)"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def _json_bytes(obj) -> bytes:
+    """Компактный JSON одного объекта (UTF-8 bytes)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def write_json(data: dict, out) -> None:
+    """Потоковая запись экспорта в JSON (out — бинарный файл)
+
+    Поля экспорта, затем чаты по одному на строку: в памяти одновременно
+    только сериализация одного чата, а не всего экспорта.
+    """
+    header = {k: v for k, v in data.items() if k != "chats"}
+    out.write(_json_bytes(header)[:-1] + b',"chats":[\n' if header else b'{"chats":[\n')
+    for i, chat in enumerate(data.get("chats", [])):
+        if i:
+            out.write(b",\n")
+        out.write(_json_bytes(chat))
+    out.write(b"\n]}\n")
+
+
+# Место панелей чатов в шаблоне страницы: до него пишем шапку, после — хвост
+_PANELS_MARKER = "\x00panels\x00"
 
 
 def format_as_html(data: dict, avatars: dict = None, names: dict = None, mobile: bool = False, files_url_map: dict = None) -> str:
+    """Форматирование в HTML одной строкой (для больших экспортов — write_html в файл)"""
+    out = io.StringIO()
+    write_html(data, out, avatars=avatars, names=names, mobile=mobile, files_url_map=files_url_map)
+    return out.getvalue()
+
+
+def write_html(data: dict, out, avatars: dict = None, names: dict = None, mobile: bool = False, files_url_map: dict = None) -> None:
     """
-    Форматирование в HTML - современный дизайн 2025
+    Потоковая запись экспорта в HTML - современный дизайн 2025
     Светлая/тёмная тема, CSS-переключение чатов, аватарки
 
+    Сообщения пишутся в out по одному, без сборки всей страницы в памяти.
+
     Args:
         data: Данные экспорта
+        out: Текстовый файл для записи
         avatars: Словарь {sn: bytes} с аватарками (опционально)
         names: Словарь {sn: display_name} для отображения имён (опционально)
         mobile: Если True, генерировать мобильную версию
@@ -35,9 +79,9 @@ def format_as_html(data: dict, avatars: dict = None, names: dict = None, mobile:
     total_messages = sum(len(c.get("messages", [])) for c in chats)
     export_date = data.get("export_date", datetime.now().isoformat())[:10]
 
-    # Генерируем список чатов (sidebar) и контент
+    # Генерируем список чатов (sidebar); панели с сообщениями пишутся потом, прямо в out
     sidebar_items = ""
-    content_panels = ""
+    panels = []  # [(idx, chat, chat_name, avatar_html, chat_members, is_personal, pinned_html)]
 
     for idx, chat in enumerate(chats):
         chat_sn = chat.get("chat_sn", "")
@@ -138,19 +182,6 @@ def format_as_html(data: dict, avatars: dict = None, names: dict = None, mobile:
                     "sn": sender_sn
                 }
 
-        # Сообщения чата
-        messages_html = ""
-        current_date = ""
-        for msg in messages:
-            msg_time = msg.get("time", 0)
-            if msg_time:
-                msg_date = datetime.fromtimestamp(msg_time).strftime("%d.%m.%Y")
-                if msg_date != current_date:
-                    current_date = msg_date
-                    messages_html += f'<div class="date-sep"><span>{msg_date}</span></div>'
-
-            messages_html += render_message(msg, chat_members=chat_members, chat_sn=chat_sn, is_personal=is_personal, names=names, files_url_map=files_url_map)
-
         # Закреплённые
         pinned = chat.get("pinned_messages", [])
         pinned_html = ""
@@ -185,34 +216,9 @@ def format_as_html(data: dict, avatars: dict = None, names: dict = None, mobile:
 </label>
 '''
 
-        content_panels += f'''
-<div class="chat-panel" id="p{idx}">
-    <div class="panel-header">
-        <label for="closeChat" class="back-btn">‹</label>
-        <div class="avatar sm">{avatar_html}</div>
-        <div class="header-info">
-            <div class="header-name">{chat_name}</div>
-            <div class="header-sub">{msg_count} сообщений</div>
-        </div>
-        <button class="search-toggle" onclick="toggleSearch(this)">
-            <svg width="20" height="20" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
-                <circle cx="11" cy="11" r="8"/><path d="m21 21-4.35-4.35"/>
-            </svg>
-        </button>
-    </div>
-    <div class="panel-search">
-        <input type="text" placeholder="Поиск в чате..." oninput="searchInChat(this)" onkeydown="searchInChat(this,event)">
-        <span class="search-info"></span>
-        <button onclick="navSearch(this,-1)">↑</button>
-        <button onclick="navSearch(this,1)">↓</button>
-        <button onclick="closeSearch(this)">✕</button>
-    </div>
-    {pinned_html}
-    <div class="messages">{messages_html}</div>
-</div>
-'''
+        panels.append((idx, chat, chat_name, avatar_html, chat_members, is_personal, pinned_html))
 
-    return f'''<!DOCTYPE html>
+    page = f'''<!DOCTYPE html>
 <html lang="ru">
 <head>
 <meta charset="UTF-8">
@@ -587,7 +593,7 @@ body{{font-family:'Inter',-apple-system,BlinkMacSystemFont,'Segoe UI',Roboto,san
 
     <div class="main" id="main">
         <div class="placeholder">👈 Выберите чат</div>
-        {content_panels}
+        {_PANELS_MARKER}
     </div>
 </div>
 
@@ -844,6 +850,50 @@ function toggleTheme(){{
 </script>
 </body>
 </html>'''
+    head, tail = page.split(_PANELS_MARKER, 1)
+    del page
+    out.write(head)
+
+    for idx, chat, chat_name, avatar_html, chat_members, is_personal, pinned_html in panels:
+        chat_sn = chat.get("chat_sn", "")
+        messages = chat.get("messages", [])
+        out.write(f'''
+<div class="chat-panel" id="p{idx}">
+    <div class="panel-header">
+        <label for="closeChat" class="back-btn">‹</label>
+        <div class="avatar sm">{avatar_html}</div>
+        <div class="header-info">
+            <div class="header-name">{chat_name}</div>
+            <div class="header-sub">{len(messages)} сообщений</div>
+        </div>
+        <button class="search-toggle" onclick="toggleSearch(this)">
+            <svg width="20" height="20" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
+                <circle cx="11" cy="11" r="8"/><path d="m21 21-4.35-4.35"/>
+            </svg>
+        </button>
+    </div>
+    <div class="panel-search">
+        <input type="text" placeholder="Поиск в чате..." oninput="searchInChat(this)" onkeydown="searchInChat(this,event)">
+        <span class="search-info"></span>
+        <button onclick="navSearch(this,-1)">↑</button>
+        <button onclick="navSearch(this,1)">↓</button>
+        <button onclick="closeSearch(this)">✕</button>
+    </div>
+    {pinned_html}
+    <div class="messages">''')
+        current_date = ""
+        for msg in messages:
+            msg_time = msg.get("time", 0)
+            if msg_time:
+                msg_date = datetime.fromtimestamp(msg_time).strftime("%d.%m.%Y")
+                if msg_date != current_date:
+                    current_date = msg_date
+                    out.write(f'<div class="date-sep"><span>{msg_date}</span></div>')
+
+            out.write(render_message(msg, chat_members=chat_members, chat_sn=chat_sn, is_personal=is_personal, names=names, files_url_map=files_url_map))
+        out.write('</div>\n</div>\n')
+
+    out.write(tail)
 
 
 def render_message(msg: dict, pinned: bool = False, chat_members: dict = None, chat_sn: str = "", is_personal: bool = False, names: dict = None, files_url_map: dict = None) -> str:
@@ -3,14 +3,19 @@ Simple statistics tracking with SQLite
 Lightweight monitoring for VK Teams Export Bot
 """
 
+import logging
 import sqlite3
 import os
+import queue
 import subprocess
+import threading
 from datetime import datetime, timedelta
 from contextlib import contextmanager
 
 DB_PATH = os.environ.get("STATS_DB_PATH", "data/stats.db")
 
+logger = logging.getLogger(__name__)
+
 
 def get_system_metrics() -> dict:
     """Get system metrics (CPU, memory, disk)"""
@@ -155,16 +160,55 @@ def get_db():
         conn.close()
 
 
+# События пишет фоновый поток пачками — вызывающий (event loop бота) не ждёт SQLite.
+# stats_server читает ту же БД, поэтому свежие события видит с задержкой на одну пачку
+_events_queue: queue.SimpleQueue = queue.SimpleQueue()
+_events_writer = None
+_events_lock = threading.Lock()
+
+
+def _write_events():
+    """Фоновый писатель событий: забирает всё накопленное и вставляет одной транзакцией"""
+    while True:
+        batch = [_events_queue.get()]
+        while True:
+            try:
+                batch.append(_events_queue.get_nowait())
+            except queue.Empty:
+                break
+        rows = [row for row in batch if row is not None]
+        if rows:
+            try:
+                with get_db() as conn:
+                    conn.executemany(
+                        "INSERT INTO events (timestamp, event_type, user_id, data) VALUES (?, ?, ?, ?)",
+                        rows
+                    )
+            except Exception as e:
+                logger.warning("Stats events write failed, %d events dropped: %s", len(rows), e)
+        if len(rows) != len(batch):
+            return  # Получен сигнал остановки (None)
+
+
 def log_event(event_type: str, user_id: int = None, data: str = None):
-    """Log an event"""
-    try:
-        with get_db() as conn:
-            conn.execute(
-                "INSERT INTO events (timestamp, event_type, user_id, data) VALUES (?, ?, ?, ?)",
-                (datetime.now().isoformat(), event_type, user_id, data)
-            )
-    except Exception as e:
-        print(f"Stats error: {e}")
+    """Log an event (asynchronously, via background writer thread)"""
+    global _events_writer
+    if _events_writer is None:
+        with _events_lock:
+            if _events_writer is None:
+                _events_writer = threading.Thread(target=_write_events, name="stats-events", daemon=True)
+                _events_writer.start()
+    _events_queue.put((datetime.now().isoformat(), event_type, user_id, data))
+
+
+def flush_events(timeout: float = 10.0):
+    """Дописать накопленные события и остановить фоновый поток (при завершении)"""
+    global _events_writer
+    with _events_lock:
+        writer, _events_writer = _events_writer, None
+    if writer is not None:
+        _events_queue.put(None)
+        writer.join(timeout)
 
 
 def update_active_user(user_id: int, username: str = None, email: str = None):
@@ -342,25 +386,49 @@ def get_active_user_ids(days: int = 30) -> list[int]:
         return []
 
 
+# Settings are written only by the bot process, so reads are served from memory
+_settings_cache: dict[str, str] = {}
+
+
+def get_settings(keys: list[str]) -> dict[str, str]:
+    """Read several global settings in one query (missing keys are omitted)"""
+    missing = [key for key in keys if key not in _settings_cache]
+    if missing:
+        try:
+            with get_db() as conn:
+                placeholders = ",".join("?" * len(missing))
+                rows = conn.execute(
+                    f"SELECT key, value FROM settings WHERE key IN ({placeholders})", missing
+                ).fetchall()
+            _settings_cache.update((row[0], row[1]) for row in rows)
+        except Exception:
+            pass
+    return {key: _settings_cache[key] for key in keys if key in _settings_cache}
+
+
 def get_setting(key: str, default: str = "") -> str:
     """Read a global setting from the settings table"""
-    try:
-        with get_db() as conn:
-            row = conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
-            return row[0] if row else default
-    except Exception:
-        return default
+    return get_settings([key]).get(key, default)
 
 
-def set_setting(key: str, value: str):
-    """Write a global setting"""
+def set_settings(values: dict[str, str]):
+    """Write several global settings in one transaction"""
     try:
         with get_db() as conn:
-            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+            conn.executemany(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", list(values.items())
+            )
+        _settings_cache.update(values)
     except Exception as e:
+        _settings_cache.clear()
         print(f"Stats error: {e}")
 
 
+def set_setting(key: str, value: str):
+    """Write a global setting"""
+    set_settings({key: value})
+
+
 # Initialize on import
 try:
     init_db()
@@ -0,0 +1,126 @@
+"""
+Хранилище пользовательского состояния
+
+В памяти процесса — LRU + TTL: неактивные пользователи вытесняются, чтобы словари
+не росли бесконечно. Auth-сессии дополнительно сохраняются в Redis (если задан
+REDIS_URL), чтобы переживать перезапуск и вытеснение из памяти. Выбор чатов,
+поисковый запрос и id сообщений остаются только в памяти: после перезапуска
+пользователь выбирает чаты заново.
+"""
+
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Callable, Optional
+
+import orjson
+
+
+class UserStateLRU(MutableMapping):
+    """dict {user_id: value} с LRU-вытеснением и TTL
+
+    OrderedDict хранит ключи в порядке последнего обращения: move_to_end и
+    вытеснение самых старых — O(1). Пользователей, для которых is_locked()
+    возвращает True (идёт экспорт), не вытесняем.
+    """
+
+    def __init__(self, max_size: int, ttl: float, is_locked: Optional[Callable[[int], bool]] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._is_locked = is_locked or (lambda key: False)
+        self._data: OrderedDict = OrderedDict()  # {key: (value, last_access)}
+
+    def __getitem__(self, key):
+        value, touched = self._data[key]
+        now = time.monotonic()
+        if now - touched > self.ttl and not self._is_locked(key):
+            del self._data[key]
+            raise KeyError(key)
+        self._data[key] = (value, now)
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        self._evict()
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key) -> bool:
+        # Без обновления LRU-порядка: проверка наличия — не обращение
+        entry = self._data.get(key)
+        if entry is None:
+            return False
+        return time.monotonic() - entry[1] <= self.ttl or self._is_locked(key)
+
+    def __iter__(self):
+        # Просроченные записи для __contains__/__getitem__ уже отсутствуют — вытесняем их и здесь.
+        # Снимок ключей: по словарю можно итерироваться и удалять из него
+        self._evict()
+        return iter(list(self._data))
+
+    def __len__(self) -> int:
+        self._evict()
+        return len(self._data)
+
+    def evict_expired(self):
+        """Вытеснить просроченные записи без вставки (периодическая уборка)"""
+        self._evict()
+
+    def _evict(self):
+        """Вытеснить просроченные и лишние записи с начала очереди"""
+        now = time.monotonic()
+        excess = len(self._data) - self.max_size
+        stale = []
+        for key, (_, touched) in self._data.items():
+            if excess <= 0 and now - touched <= self.ttl:
+                break  # Дальше только более свежие записи
+            if self._is_locked(key):
+                continue
+            stale.append(key)
+            excess -= 1
+        for key in stale:
+            del self._data[key]
+
+
+class RedisSessionStore:
+    """Auth-сессии VK Teams в Redis: {user_id: {aimsid, email, fetch_base_url}} с TTL
+
+    Хранятся только поля авторизации (orjson). Список контактов кешируется
+    отдельно по email с коротким TTL — после перезапуска /chats не ходит в API.
+    """
+
+    def __init__(self, url: str, ttl: int, prefix: str = "sess:"):
+        from redis.asyncio import Redis
+
+        self._redis = Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def load(self, user_id: int) -> Optional[dict]:
+        """Прочитать сессию и продлить её TTL (None — нет или истекла)"""
+        key = f"{self.prefix}{user_id}"
+        raw = await self._redis.getex(key, ex=self.ttl)
+        return orjson.loads(raw) if raw else None
+
+    async def save(self, user_id: int, data: dict):
+        await self._redis.set(f"{self.prefix}{user_id}", orjson.dumps(data), ex=self.ttl)
+
+    async def delete(self, user_id: int):
+        await self._redis.delete(f"{self.prefix}{user_id}")
+
+    async def load_contacts(self, email: str) -> Optional[list]:
+        """Список контактов из look-aside кеша (None — промах)"""
+        raw = await self._redis.get(f"contacts:{email}")
+        return orjson.loads(raw) if raw else None
+
+    async def save_contacts(self, email: str, contacts: list, ttl: int):
+        await self._redis.set(f"contacts:{email}", orjson.dumps(contacts), ex=ttl)
+
+    async def delete_contacts(self, email: str):
+        await self._redis.delete(f"contacts:{email}")
+
+    async def close(self):
+        await self._redis.aclose()
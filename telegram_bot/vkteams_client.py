@@ -4,7 +4,10 @@ VK Teams API Client
 """
 
 import asyncio
+import os
+import aiofiles
 import aiohttp
+from aiolimiter import AsyncLimiter
 from aiohttp.resolver import AsyncResolver
 import random
 import time
@@ -13,11 +16,7 @@ from dataclasses import dataclass, field
 from typing import Optional
 import config
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Логгер модуля; уровень и обработчики настраивает точка входа (bot.main)
 logger = logging.getLogger(__name__)
 
 
@@ -715,6 +714,47 @@ class VKTeamsClient:
             logger.debug(f"download_file: error for {url[:80]}: {e}")
             return None
 
+    async def stream_file(self, url: str, dest_path: str, max_size: int = 50 * 1024 * 1024, chunk_size: int = 64 * 1024) -> int:
+        """Download file by URL straight to disk, chunk by chunk. Returns bytes written (0 on error).
+        Memory use is O(chunk_size) regardless of file size; partial files are removed.
+        """
+        headers = {
+            "Origin": "https://myteam.mail.ru",
+            "Referer": "https://myteam.mail.ru/",
+            "x-teams-aimsid": self.session.aimsid,
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+        }
+        http = self._get_http_session()
+        written = 0
+        try:
+            # Без общего таймаута: большой файл может качаться долго, ограничиваем только простой чтения
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+            async with http.get(url, headers=headers, timeout=timeout) as response:
+                if response.status != 200:
+                    logger.debug(f"stream_file: status {response.status} for {url[:80]}")
+                    return 0
+                content_length = response.headers.get("Content-Length")
+                if content_length and int(content_length) > max_size:
+                    logger.info(f"stream_file: file too large ({content_length} bytes), skipping")
+                    return 0
+                async with aiofiles.open(dest_path, "wb") as f:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        written += len(chunk)
+                        if written > max_size:
+                            raise ValueError(f"file too large (>{max_size} bytes)")
+                        await f.write(chunk)
+                return written
+        except asyncio.TimeoutError:
+            logger.debug(f"stream_file: timeout for {url[:80]}")
+        except Exception as e:
+            logger.debug(f"stream_file: error for {url[:80]}: {e}")
+        # Не оставляем недокачанный файл
+        try:
+            os.remove(dest_path)
+        except OSError:
+            pass
+        return 0
+
     async def get_avatars_batch(self, sns: list[str], size: str = "small") -> dict[str, bytes]:
         """
         Download avatars for multiple users/chats.
@@ -726,34 +766,21 @@ class VKTeamsClient:
         Returns:
             Dict mapping sn -> image bytes (only for successful downloads)
         """
-        avatars = {}
-        failed = []
-        delay = 0.2  # Start with 200ms delay (5 req/sec)
-        consecutive_failures = 0
-
-        for i, sn in enumerate(sns, 1):
-            try:
-                data = await self.get_avatar(sn, size)
-                if data:
-                    avatars[sn] = data
-                    consecutive_failures = 0  # Reset on success
-                    if i % 10 == 0:  # Log every 10 avatars
-                        logger.info(f"Avatar progress: {len(avatars)}/{i} (delay: {delay:.2f}s)")
-                else:
-                    failed.append(sn)
-                    consecutive_failures += 1
-            except Exception as e:
-                failed.append(sn)
-                consecutive_failures += 1
-                logger.debug(f"Avatar error for {sn}: {e}")
-
-            # Adaptive rate limiting: increase delay if many failures
-            if consecutive_failures >= 5:
-                delay = min(delay * 1.5, 2.0)  # Max 2 seconds
-                logger.info(f"Rate limit detected, increasing delay to {delay:.2f}s")
-                consecutive_failures = 0
-
-            await asyncio.sleep(delay)
+        # Несколько загрузок одновременно, общий темп — не выше AVATAR_RATE_PER_SEC (как в боте)
+        sem = asyncio.Semaphore(config.AVATAR_WORKERS)
+        limiter = AsyncLimiter(config.AVATAR_RATE_PER_SEC, 1)
+
+        async def _fetch_one(sn: str) -> tuple[str, Optional[bytes]]:
+            async with sem, limiter:
+                try:
+                    return sn, await self.get_avatar(sn, size)
+                except Exception as e:
+                    logger.debug(f"Avatar error for {sn}: {e}")
+                    return sn, None
+
+        results = await asyncio.gather(*(_fetch_one(sn) for sn in sns))
+        avatars = {sn: data for sn, data in results if data}
+        failed = [sn for sn, data in results if not data]
 
         logger.info(f"Downloaded {len(avatars)}/{len(sns)} avatars ({len(failed)} failed)")
         if failed and len(failed) <= 5: